@@ -17,15 +17,33 @@ and never point this at data you don't have a separate backup of.
 """
 
 import argparse
+import hashlib
+import json
+import mmap
+import os
+import random
 import shutil
+import struct
+import threading
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from pathlib import Path
 
+try:
+    import numpy as np
+except ImportError:  # only needed for MegapackReader.array()
+    np = None
+
 DEFAULT_FILECOUNT_THRESH = 40
 DEFAULT_FILESIZE_THRESH = 12_000_000
+DEFAULT_SPOT_CHECK = 1
+COPY_CHUNKSIZE = 1 << 20  # 1 MiB chunks for packing and spot checks
+JOURNAL_VERSION = 1
 
 
-def compress_directory(dir_path, zip_path, manifest=False):
+def compress_directory(dir_path, zip_path, manifest=False, md5=False):
     """Pack a directory into a store-only ZIP file (without data 
     compression).
 
@@ -33,57 +51,595 @@ def compress_directory(dir_path, zip_path, manifest=False):
     caller is responsible for filtering out any nested directories
     beforehand.
 
+    Each file is read only once: its CRC-32 (and MD5, if md5 is True)
+    is computed from the same chunks that are written into the ZIP file.
+    A file whose size changes while it is being packed raises a
+    RuntimeError. The ZIP file is flushed to disk (fsync) before
+    returning.
+
     If manifest is True, also write a tab-delimited manifest file
     (same name as zip_path, with '.manifest.txt' as suffix) listing
-    each archived file's name, byte offset, size, and CRC-32.
+    each archived file's name, byte offset, size, and CRC-32 (and MD5).
+
+    Returns a list of (filename, size, crc32, md5 hexdigest or None)
+    records, one per archived file, for verify_zip().
     """
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zipf:
-        for file in dir_path.iterdir():
-            if file.is_file():
-                zipf.write(file, arcname=file.name)
-
-        if manifest:
-            manifest_path = zip_path.with_suffix('.manifest.txt')
-            with manifest_path.open('w') as f:
-                f.write("filename\tbyte_offset\tfile_size\tcrc32\n")
-                for info in zipf.infolist():
-                    f.write(
-                        f"{info.filename}\t{info.header_offset}\t"
-                        f"{info.file_size}\t{info.CRC:08x}\n"
-                    )
-
-
-def scan_directory(root, file_count_threshold):
-    qualifying_dirs = []
+    records = []
+    with open(zip_path, 'wb') as fzip:
+        with zipfile.ZipFile(fzip, 'w', zipfile.ZIP_STORED) as zipf:
+            for file in dir_path.iterdir():
+                if not file.is_file():
+                    continue
+                zinfo = zipfile.ZipInfo.from_file(file, arcname=file.name)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                crc = 0
+                size = 0
+                hasher = hashlib.md5() if md5 else None
+                with file.open('rb') as src, zipf.open(zinfo, 'w') as dst:
+                    while True:
+                        chunk = src.read(COPY_CHUNKSIZE)
+                        if not chunk:
+                            break
+                        crc = zlib.crc32(chunk, crc)
+                        if hasher:
+                            hasher.update(chunk)
+                        size += len(chunk)
+                        dst.write(chunk)
+                    if size != zinfo.file_size or \
+                       size != os.fstat(src.fileno()).st_size:
+                        raise RuntimeError(f"File changed while packing: {file}")
+                records.append((file.name, size, crc,
+                                hasher.hexdigest() if hasher else None))
+
+            if manifest:
+                manifest_path = zip_path.with_suffix('.manifest.txt')
+                with manifest_path.open('w') as f:
+                    f.write("filename\tbyte_offset\tfile_size\tcrc32"
+                            + ("\tmd5\n" if md5 else "\n"))
+                    for info, record in zip(zipf.infolist(), records):
+                        f.write(
+                            f"{info.filename}\t{info.header_offset}\t"
+                            f"{info.file_size}\t{info.CRC:08x}"
+                            + (f"\t{record[3]}\n" if md5 else "\n")
+                        )
+        fzip.flush()
+        os.fsync(fzip.fileno())
+    return records
+
+
+def verify_zip(zip_path, records, spot_check=0):
+    """Verify a ZIP file written by compress_directory() against the
+    records it returned, without reading the archived data back.
+
+    The central directory must list exactly the archived files, with the
+    sizes and CRC-32 values computed from the source files. In addition,
+    spot_check randomly chosen members are read back from disk and checked
+    (CRC-32, and MD5 if available).
+
+    Raises a RuntimeError (or zipfile.BadZipFile, for a member that
+    fails the spot check) if the ZIP file does not match.
+    """
+    expected = {name: (size, crc, md5hex) for name, size, crc, md5hex in records}
+    with zipfile.ZipFile(zip_path) as zf:
+        infolist = zf.infolist()
+        if len(infolist) != len(records) or len(expected) != len(records):
+            raise RuntimeError(f"{len(infolist)} members in the zip, "
+                               f"{len(records)} files archived")
+        for info in infolist:
+            size, crc, _ = expected.get(info.filename, (None, None, None))
+            if (info.file_size, info.compress_size, info.CRC) != (size, size, crc):
+                raise RuntimeError(f"Member {info.filename} does not match its source file")
+        for info in random.sample(infolist, min(spot_check, len(infolist))):
+            hasher = hashlib.md5()
+            # ZipExtFile checks the CRC-32 when the member has been read
+            with zf.open(info) as member:
+                while True:
+                    chunk = member.read(COPY_CHUNKSIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+            md5hex = expected[info.filename][2]
+            if md5hex is not None and hasher.hexdigest() != md5hex:
+                raise RuntimeError(f"Member {info.filename} does not match its source file (MD5)")
+
+
+def read_manifest(manifest_path):
+    """Read a manifest file written by compress_directory().
+
+    Returns a list of (filename, byte_offset, size, crc32, md5 hexdigest
+    or None) tuples.
+    """
+    entries = []
+    with Path(manifest_path).open('r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header[:4] != ["filename", "byte_offset", "file_size", "crc32"]:
+            raise ValueError(f"Not a megapack manifest: {manifest_path}")
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            entries.append((fields[0], int(fields[1]), int(fields[2]),
+                            int(fields[3], 16),
+                            fields[4] if len(fields) > 4 else None))
+    return entries
+
+
+def records_digest(records):
+    """MD5 digest of the (filename, size, crc32) records of a zip file, as
+    returned by compress_directory(), for the journal."""
+    hasher = hashlib.md5()
+    for name, size, crc, _ in records:
+        hasher.update(f"{name}\t{size}\t{crc:08x}\n".encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class Journal:
+    """Journal of a megapack run (--journal, --resume).
+
+    A JSON-lines file: a header with the settings of the run, followed by
+    one line each time a directory reaches a new state ('planned',
+    'zipped', 'verified', 'moved'), is skipped ('skipped') or fails
+    ('failed', with the last completed state in 'failed_after').
+    Directories are identified by their path relative to the
+    root directory. Each line is flushed to disk (fsync) before the run
+    continues, so that an interrupted run can be resumed from the last
+    recorded state of each directory. Lines can be written from several
+    threads.
+    """
+
+    def __init__(self, path, header=None):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        if header is not None:
+            # a new journal, never overwrite an existing one
+            self.f = self.path.open('x', encoding='utf-8')
+            self._write(dict(header, megapack_journal=JOURNAL_VERSION))
+        else:
+            self.f = self.path.open('a', encoding='utf-8')
+            if self.f.tell() > 0:
+                with self.path.open('rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        # end the incomplete last line of an interrupted run
+                        self._write_raw("\n")
+
+    def _write(self, entry):
+        self._write_raw(json.dumps(entry) + "\n")
+
+    def _write_raw(self, text):
+        with self.lock:
+            self.f.write(text)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def record(self, rel, state, **info):
+        self._write(dict({"dir": rel, "state": state,
+                          "time": datetime.now().isoformat()}, **info))
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def load(path):
+        """Read a journal. Returns the header and a dict with the last
+        entry for each directory (in the order in which they were first
+        recorded). Incomplete lines (interrupted run) are ignored.
+        """
+        with Path(path).open('r', encoding='utf-8') as f:
+            lines = f.read().split("\n")
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            header = {}
+        if header.get("megapack_journal") != JOURNAL_VERSION:
+            raise ValueError(f"Not a megapack journal: {path}")
+        entries = {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # line being written when the run was interrupted: the
+                # directory resumes from its previous (earlier) state
+                continue
+            entries[entry["dir"]] = entry
+        return header, entries
+
+
+class MegapackReader:
+    """Random access to the files in a ZIP file written by megapack.
+
+    The archive is memory-mapped once, and the position of each member is
+    taken from the manifest file ('.manifest.txt' next to the zip file).
+    Without a manifest, it is taken from the central directory of the zip
+    file instead. Since members are stored without compression, they are
+    returned as memoryview slices of the mapped archive, or NumPy arrays
+    on top of these (array()), without reading or copying data until it
+    is used.
+
+    The returned views refer to the mapped archive: release them (del)
+    before calling close(), or use the reader as a context manager that
+    outlives them.
+
+    Example:
+        with MegapackReader('run01.zip') as mp:
+            spectra = mp.arrays(mp.names, dtype='<f8')
+    """
+
+    # local file header: signature, ..., compression method at 8,
+    # file name length and extra field length at 26
+    _LOCAL_HEADER = struct.Struct('<4s4xH16xHH')
+
+    def __init__(self, zip_path, manifest_path=None):
+        self.zip_path = Path(zip_path)
+        if manifest_path is None:
+            manifest_path = self.zip_path.with_suffix('.manifest.txt')
+        manifest_path = Path(manifest_path)
+        if manifest_path.exists():
+            entries = read_manifest(manifest_path)
+        else:
+            with zipfile.ZipFile(self.zip_path) as zf:
+                entries = [(info.filename, info.header_offset,
+                            info.file_size, info.CRC, None)
+                           for info in zf.infolist()]
+
+        with self.zip_path.open('rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        self.names = []
+        self._members = {}
+        for name, header_offset, size, crc, _ in entries:
+            signature, method, namelen, extralen = \
+                self._LOCAL_HEADER.unpack_from(self._mmap, header_offset)
+            if signature != b'PK\x03\x04' or \
+               self._mmap[header_offset + 30:header_offset + 30 + namelen] \
+                    != name.encode('utf-8'):
+                raise ValueError(f"No member {name} at offset "
+                                 f"{header_offset} in {self.zip_path}")
+            if method != zipfile.ZIP_STORED:
+                raise ValueError(f"Member {name} is compressed")
+            start = header_offset + 30 + namelen + extralen
+            if start + size > len(self._mmap):
+                raise ValueError(f"Member {name} extends beyond the end "
+                                 f"of {self.zip_path}")
+            self.names.append(name)
+            self._members[name] = (start, size, crc)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._members
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmap the archive. Raises BufferError if views are still in use."""
+        if self._mmap is not None:
+            self._view.release()
+            self._mmap.close()
+            self._mmap = None
+
+    def read(self, name):
+        """Return the contents of a member as a (read-only) memoryview."""
+        start, size, _ = self._members[name]
+        return self._view[start:start + size]
+
+    def read_many(self, names):
+        """Return the contents of several members, as a list of memoryviews.
+
+        The members are looked up in order of their position in the
+        archive, so that the pages are touched sequentially.
+        """
+        order = sorted(range(len(names)),
+                       key=lambda i: self._members[names[i]][0])
+        views = [None] * len(names)
+        for i in order:
+            views[i] = self.read(names[i])
+        return views
+
+    def array(self, name, dtype='uint8', offset=0, count=-1):
+        """Return the contents of a member as a (read-only) NumPy array,
+        without copying (numpy.frombuffer). offset (in bytes) skips a
+        header at the start of the file."""
+        if np is None:
+            raise ImportError("NumPy is required for MegapackReader.array()")
+        return np.frombuffer(self.read(name), dtype=dtype, count=count,
+                             offset=offset)
+
+    def arrays(self, names, dtype='uint8', offset=0, count=-1):
+        """Return several members as a list of NumPy arrays (see array())."""
+        if np is None:
+            raise ImportError("NumPy is required for MegapackReader.arrays()")
+        return [np.frombuffer(view, dtype=dtype, count=count, offset=offset)
+                for view in self.read_many(names)]
+
+    def verify(self, name):
+        """Check the CRC-32 of a member against the manifest."""
+        start, size, crc = self._members[name]
+        return zlib.crc32(self._view[start:start + size]) == crc
+
+
+def scan_directory(root, file_count_threshold, file_size_threshold=None):
+    """Walk the tree below root in a single pass, yielding a dict for
+    each directory with more than file_count_threshold files, as soon as
+    it has been scanned.
+
+    Uses os.scandir(), so that the type of each entry comes from the
+    directory listing itself. Only the files in directories above the
+    file count threshold are stat()ed, for their size. Symbolic links to
+    directories count as subdirectories, but are not followed.
+
+    If file_size_threshold is given, the dict also tells whether the
+    directory fully qualifies for packing ("qualifies": no file larger
+    than the threshold, no subdirectories).
+    """
+    stack = [str(root)]
+    scanned = 0
+    while stack:
+        top = stack.pop()
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry)
+                    elif entry.is_file():
+                        files.append(entry)
+        except OSError as e:
+            print(f"\nWARNING (cannot scan):\t{top}\t{e}")
+            continue
+        # depth-first, in name order
+        stack.extend(sorted((d.path for d in subdirs
+                             if not d.is_symlink()), reverse=True))
+
+        if top != str(root):
+            scanned += 1
+            if len(files) > file_count_threshold:
+                largest_file_size = max(f.stat().st_size for f in files)
+                d = {
+                    "path": top,
+                    "file_count": len(files),
+                    "largest_file_size": largest_file_size,
+                    "has_subdirs": len(subdirs) > 0,
+                }
+                if file_size_threshold is not None:
+                    d["qualifies"] = (largest_file_size <= file_size_threshold
+                                      and not d["has_subdirs"])
+                yield d
+        if scanned and (scanned % 1000 == 0):
+            print(f"Scanning directories: {scanned}", end="\r")
+
+    print(f"Scanning directories: {scanned}")
+
+
+def process_directory(dir_path, root, backup_root, zip_overwrite=False,
+                      md5=False, spot_check=DEFAULT_SPOT_CHECK,
+                      journal=None, resume=None):
+    """Zip, verify and move a single directory.
+
+    With a journal, each step is recorded as it completes. resume is the
+    last journal entry for the directory, when resuming an interrupted
+    run: processing continues after the last completed step (for a
+    directory that failed, the step completed before the failure). A zip
+    file of a directory that was only 'planned' was left incomplete by the
+    interrupted run, and is removed first. A 'zipped' zip file is verified
+    against the manifest, provided that the manifest matches the checksums
+    recorded in the journal; otherwise, the directory is zipped again. A
+    zip file that failed verification does not count as 'zipped'.
+
+    Returns a dict with the path, the status ('ok', 'skipped' or
+    'failed'), the error message (if any), and the log lines, which are
+    collected rather than printed, so that the output of directories
+    processed in parallel does not get mixed up. Any exception is caught
+    and reported as a failure of this directory only.
+    """
+    zip_path = dir_path.parent / (dir_path.name + '.zip')
+    manifest_path = zip_path.with_suffix('.manifest.txt')
+    rel = dir_path.relative_to(root).as_posix()
+    state = None
+    if resume is not None:
+        state = resume["state"]
+        if state == 'failed':
+            state = resume["failed_after"]
+    # last completed step, recorded with a failure
+    completed = {"failed_after": state or 'planned'}
+    if state in ('zipped', 'verified'):
+        completed.update((key, resume[key]) for key in
+                         ("files", "bytes", "zip_size", "records_md5")
+                         if key in resume)
+    log = []
+    result = {"path": str(dir_path), "status": "failed", "error": "",
+              "log": log}
+    try:
+        records = None
+        if state == 'zipped':
+            if manifest_path.exists():
+                records = [(name, size, crc, md5hex) for name, _, size, crc, md5hex
+                           in read_manifest(manifest_path)]
+            if records is None or \
+               records_digest(records) != resume.get("records_md5"):
+                log.append("Manifest missing or not matching the journal, zipping again")
+                state = 'planned'
+                records = None
+                completed = {"failed_after": state}
+
+        if state == 'planned' and zip_path.exists():
+            # left incomplete by the interrupted run
+            log.append(f"Removing incomplete zip {zip_path}")
+            zip_path.unlink()
+            manifest_path.unlink(missing_ok=True)
+
+        if state in (None, 'planned'):
+            if zip_path.exists():
+                if zip_overwrite:
+                    log.append(f"Overwriting existing zip {zip_path}")
+                else:
+                    log.append(f"SKIPPING (no '--zip-overwrite'). Target zip already exists: {dir_path} -> {zip_path}")
+                    result["status"] = "skipped"
+                    if journal:
+                        journal.record(rel, 'skipped')
+                    return result
+            log.append(f"Zipping to {zip_path}")
+            state = 'zipping'
+
+        if state in ('zipping', 'zipped'):
+            try:
+                if records is None:
+                    records = compress_directory(dir_path, zip_path,
+                                                 manifest=True, md5=md5)
+                    completed = dict(zip_summary(zip_path, records),
+                                     failed_after='zipped')
+                    if journal:
+                        journal.record(rel, 'zipped', **zip_summary(zip_path, records))
+                else:
+                    log.append(f"Verifying {zip_path}")
+                # Verify integrity before destroying the original.
+                verify_zip(zip_path, records, spot_check)
+            except Exception as e:
+                # the zip is incomplete or corrupt: zip again when resuming
+                completed = {"failed_after": 'planned'}
+                # On failure the corrupt zip is left behind next to the intact
+                # source directory. Remove the zip manually before re-running
+                # (or resume the run from its journal), or the next run will
+                # treat it as already-processed and skip the directory with a
+                # "target zip already exists" message.
+                raise RuntimeError(
+                    f"Packing or verification failed for {zip_path} (source: {dir_path}): {e}. "
+                    f"The source directory was left untouched. Delete the corrupt "
+                    f"zip before re-running, or it will be skipped as already-processed."
+                ) from e
+            log.append('Zip OK')
+            completed = dict(zip_summary(zip_path, records),
+                             failed_after='verified')
+            if journal:
+                journal.record(rel, 'verified', **zip_summary(zip_path, records))
+            state = 'verified'
+
+        if state == 'verified':
+            backup_path = backup_root / dir_path.relative_to(root)
+            if resume is not None and not dir_path.exists() and backup_path.is_dir():
+                # moved by the interrupted run, but not recorded
+                log.append(f"Already moved {dir_path} -> {backup_path}")
+            else:
+                if backup_path.exists():
+                    # shutil.move() would move the directory inside it
+                    raise FileExistsError(f"Backup path already exists: {backup_path}")
+                backup_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(dir_path), str(backup_path))
+                log.append(f"Moved {dir_path} -> {backup_path}")
+            if journal:
+                journal.record(rel, 'moved', backup=str(backup_path.resolve()))
+        result["status"] = "ok"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        log.append(f"FAILED: {result['error']}")
+        if journal:
+            journal.record(rel, 'failed', error=result["error"], **completed)
+    return result
+
+
+def zip_summary(zip_path, records):
+    """Sizes and checksum of a zip file, for the journal."""
+    return {"files": len(records),
+            "bytes": sum(size for _, size, _, _ in records),
+            "zip_size": zip_path.stat().st_size,
+            "records_md5": records_digest(records)}
+
+
+def run_jobs(dir_paths, root, backup_root, zip_overwrite=False,
+             jobs=1, md5=False, spot_check=DEFAULT_SPOT_CHECK,
+             journal=None, resume=None):
+    """Process the directories with up to `jobs` directories at a time.
+
+    resume maps the (relative) directories to their last journal entry,
+    when resuming a run. The log of each directory is printed in one
+    block when it has been processed (in order of completion). Returns
+    the results in the order of dir_paths.
+    """
+    resume = resume or {}
+    results = [None] * len(dir_paths)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(process_directory, dir_path, root, backup_root,
+                        zip_overwrite, md5, spot_check, journal,
+                        resume.get(dir_path.relative_to(root).as_posix())): i
+            for i, dir_path in enumerate(dir_paths)
+        }
+        try:
+            for n, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results[futures[future]] = result
+                print(f"[{n}/{len(futures)}] {result['path']}")
+                for line in result["log"]:
+                    print(f"    {line}")
+        except KeyboardInterrupt:
+            # let the running directories finish, but do not start others
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    return results
+
+
+def print_summary(results):
+    """Print the result for each directory. Returns the number of failures."""
+    print("\n=== Summary ===")
+    for r in results:
+        print(f"{r['status'].upper()}\t{r['path']}"
+              + (f"\t{r['error']}" if r['error'] else ""))
+    counts = {status: sum(1 for r in results if r['status'] == status)
+              for status in ('ok', 'skipped', 'failed')}
+    print(f"\n{counts['ok']} packed, {counts['skipped']} skipped,"
+          f" {counts['failed']} failed")
+    return counts['failed']
+
+
+def resume_run(journal_path, jobs=1, spot_check=DEFAULT_SPOT_CHECK):
+    """Resume an interrupted run from its journal (--resume)."""
+    header, entries = Journal.load(journal_path)
+    root = Path(header["root"])
+    backup_root = Path(header["backup_dir"])
+    todo = [rel for rel, entry in entries.items()
+            if entry["state"] not in ('moved', 'skipped')]
+
+    print(f"Resuming run of {header['started']} from journal {journal_path}")
+    print(f"Directory: {root}")
+    print(f"Backup directory: {backup_root}")
+    states = [entry["state"] for entry in entries.values()]
+    print(", ".join(f"{states.count(state)} {state}" for state in
+                    ('planned', 'zipped', 'verified', 'moved', 'skipped', 'failed')))
+    if not todo:
+        print("*** Nothing left to do.")
+        return 0
+    print("\n=== Directories to be continued ===")
+    for rel in todo:
+        state = entries[rel]['state']
+        if state == 'failed':
+            state += f" (after {entries[rel]['failed_after']})"
+        print(f"{state}\t{root / rel}")
+    confirm = input("\nProceed as planned? [y/N]: ").strip().lower()
+    if confirm != 'y':
+        print("Mission aborted.")
+        return 0
+    print()
+    journal = Journal(journal_path)
+    try:
+        results = run_jobs([root / rel for rel in todo], root, backup_root,
+                           header["zip_overwrite"], jobs, header["md5"],
+                           spot_check, journal, entries)
+    finally:
+        journal.close()
+    return print_summary(results)
 
-    print("Counting directories...")
-    all_dirs = [d for d in root.rglob('*') if d.is_dir()]
-    total_dirs = len(all_dirs)
-    print(f"Scanning {total_dirs} directories: 0/{total_dirs}", end="\r")
-
-    for i, dir_path in enumerate(all_dirs, 1):
-        files = [f for f in dir_path.iterdir() if f.is_file()]
-        subdirs = [d for d in dir_path.iterdir() if d.is_dir()]
-
-        if len(files) > file_count_threshold:
-            largest_file_size = max(f.stat().st_size for f in files) if files else 0
-            has_subdirs = len(subdirs) > 0
-            qualifying_dirs.append({
-                "path": str(dir_path),
-                "file_count": len(files),
-                "largest_file_size": largest_file_size,
-                "has_subdirs": has_subdirs,
-            })
-
-        print(f"Scanning {total_dirs} directories: {i}/{total_dirs}", end="\r")
-
-    print()  # Newline after progress
-    return qualifying_dirs
-    
 
 def main():
     parser = argparse.ArgumentParser(description="Identify directories with large numbers of small files and pack them into ZIP files without compression.")
-    parser.add_argument("directory", type=str, help="Root directory to scan")
+    parser.add_argument("directory", type=str, nargs='?', help="Root directory to scan")
     parser.add_argument("--file-count-threshold", type=int, default=DEFAULT_FILECOUNT_THRESH,
                         help=f"Minimum file count threshold (default: {DEFAULT_FILECOUNT_THRESH:d})")
     parser.add_argument("--file-size-threshold", type=int, default=DEFAULT_FILESIZE_THRESH,
@@ -100,6 +656,17 @@ def main():
                         help="Overwrite a pre-existing target zip instead of skipping the directory "
                              "(default: False). Useful to retry a directory whose zip was left "
                              "incomplete/corrupt by an interrupted (e.g. Ctrl-C) or failed previous run.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of directories to zip, verify and move in parallel (default: 1)")
+    parser.add_argument("--md5", action="store_true", default=False,
+                        help="Also compute the MD5 checksum of each file while packing, and list it in the manifest (default: False)")
+    parser.add_argument("--spot-check", type=int, default=DEFAULT_SPOT_CHECK,
+                        help=f"Number of randomly chosen files read back from each zip for verification (default: {DEFAULT_SPOT_CHECK:d})")
+    parser.add_argument("--journal", type=str, default=None,
+                        help="Journal file recording the progress of the run, with --execute "
+                             "(default: megapack-journal-<date_time>.jsonl in the backup directory)")
+    parser.add_argument("--resume", type=str, default=None, metavar="JOURNAL",
+                        help="Resume an interrupted run from its journal, without scanning the tree again")
     args = parser.parse_args()
 
     print("*" * 60)
@@ -110,6 +677,29 @@ def main():
     print("*" * 60)
     print()
 
+    if args.jobs < 1:
+        print("Error: --jobs should be at least 1.")
+        exit(1)
+    if args.spot_check < 0:
+        print("Error: --spot-check should not be negative.")
+        exit(1)
+
+    if args.resume:
+        if args.directory or args.backup_dir or args.journal:
+            print("Error: --resume takes the directories from the journal.")
+            exit(1)
+        try:
+            failed = resume_run(args.resume, args.jobs, args.spot_check)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: cannot resume from journal '{args.resume}': {e}")
+            exit(1)
+        if failed:
+            exit(1)
+        return
+
+    if not args.directory:
+        print("Error: Please supply a directory to scan.")
+        exit(1)
     root = Path(args.directory)
     if not root.exists():
         print(f"Error: Directory '{args.directory}' does not exist.")
@@ -127,7 +717,13 @@ def main():
     scan_only = args.scan_only
     zip_overwrite = args.zip_overwrite
 
-    qualifying_dirs = scan_directory(root, file_count_threshold)
+    print("=== Directories found with more than "
+          f"{file_count_threshold} files ===")
+    qualifying_dirs = []
+    for d in scan_directory(root, file_count_threshold, file_size_threshold):
+        status = "qualifies" if d["qualifies"] else "WARNING"
+        print(f"{status}\t{d['file_count']} files\t{d['path']}")
+        qualifying_dirs.append(d)
 
     # Category 2: Directories with large files
     print("\n=== Potentially qualifying directories with large files ===")
@@ -188,47 +784,41 @@ def main():
                 if confirm != 'y':
                     print("Mission aborted.")
                     return
-                print()
-                for d in fully_qualifying:
-                    dir_path = Path(d["path"])
+                if not backup_root:
+                    raise NotImplementedError("Please supply a '--backup-dir'. Source directory deletion will only be implemented when code sufficiently stress-tested in real-life situations.")
+                if args.journal:
+                    journal_path = Path(args.journal)
+                else:
+                    journal_path = backup_root / f"megapack-journal-{datetime.now():%y%m%d_%H%M%S}.jsonl"
+                try:
+                    journal = Journal(journal_path, header={
+                        "root": str(root.resolve()),
+                        "backup_dir": str(backup_root.resolve()),
+                        "zip_overwrite": zip_overwrite,
+                        "md5": args.md5,
+                        "started": datetime.now().isoformat(),
+                    })
+                except OSError as e:
+                    print(f"Error: cannot create journal '{journal_path}': {e}")
+                    exit(1)
+                print(f"Journal: {journal_path} (resume with --resume {journal_path})")
+                dir_paths = [Path(d["path"]) for d in fully_qualifying]
+                for dir_path in dir_paths:
+                    rel = dir_path.relative_to(root).as_posix()
                     zip_path = dir_path.parent / (dir_path.name + '.zip')
+                    # existing zips are never removed on --resume
+                    journal.record(rel, 'skipped' if zip_path.exists() and not zip_overwrite
+                                   else 'planned')
+                print()
+                try:
+                    results = run_jobs(dir_paths, root, backup_root,
+                                       zip_overwrite, args.jobs, args.md5,
+                                       args.spot_check, journal)
+                finally:
+                    journal.close()
 
-                    if zip_path.exists():
-                        if zip_overwrite:
-                            print(f"Overwriting existing zip {zip_path}")
-                        else:
-                            print(f"SKIPPING (no '--zip-overwrite'). Target zip already exists: {dir_path} -> {zip_path}")
-                            continue
-                        
-                    print(f"Zipping to {zip_path}")
-                    compress_directory(dir_path, zip_path, manifest=True)
-                    
-                    # Verify integrity before destroying the original.
-                    # On failure we raise rather than skip: the corrupt zip is left
-                    # behind next to the intact source directory. Remove the zip
-                    # manually before re-running, or the next run will treat it as
-                    # already-processed and skip the directory with a
-                    # "target zip already exists" message.
-                    with zipfile.ZipFile(zip_path) as zf:
-                        bad_file = zf.testzip()
-                        original_file_count = sum(1 for f in dir_path.rglob('*') if f.is_file())
-                        if bad_file or len(zf.namelist()) != original_file_count:
-                            raise RuntimeError(
-                                f"Verification failed for {zip_path} (source: {dir_path}). "
-                                f"The source directory was left untouched. Delete the corrupt "
-                                f"zip before re-running, or it will be skipped as already-processed."
-                            )
-                    print('Zip OK')
-                    
-                    if backup_root:
-                        backup_path = backup_root / dir_path.relative_to(root)
-                        backup_path.parent.mkdir(parents=True, exist_ok=True)
-                        shutil.move(str(dir_path), str(backup_path))
-                        print(f"Moved {dir_path} -> {backup_path}")
-                    else:
-                        raise NotImplementedError("Please supply a '--backup-dir'. Source directory deletion will only be implemented when code sufficiently stress-tested in real-life situations.")
-                        # shutil.rmtree(dir_path)
-                        # print(f"Deleted {dir_path}")
+                if print_summary(results):
+                    exit(1)
             else:
                 print()
                 print(60*'*')
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# superhash-catalogue.py keeps the history of a data store, as recorded by
+# the superhash files generated over time, in an SQLite database.
+#
+# Each version of a file (path, size, mtime and digest) is stored only
+# once, together with the first and the last snapshot (superhash file) in
+# which it was present. Unchanged files do not add anything to the
+# catalogue when a new snapshot is ingested.
+#
+
+__version__ = '0.6'
+
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+
+from tqdm import tqdm
+
+from superhash_format import open_superhash, tsv_reader, read_header, \
+                             iter_tsv_lines, clean_posix
+
+#%% classes and functions
+
+BATCHSIZE = 10000 # rows inserted per executemany() call
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    source_dir TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    series_id INTEGER NOT NULL REFERENCES series(id),
+    started TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    version TEXT,
+    nfiles INTEGER,
+    nbytes INTEGER,
+    ingested TEXT,
+    UNIQUE (series_id, started)
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (dir, name)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    series_id INTEGER NOT NULL REFERENCES series(id),
+    path_id INTEGER NOT NULL REFERENCES paths(id),
+    size INTEGER,
+    mtime TEXT,
+    digest TEXT,
+    first_snapshot INTEGER NOT NULL REFERENCES snapshots(id),
+    last_snapshot INTEGER REFERENCES snapshots(id)
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path_id, series_id);
+CREATE UNIQUE INDEX IF NOT EXISTS versions_current
+    ON versions (series_id, path_id) WHERE last_snapshot IS NULL;
+CREATE INDEX IF NOT EXISTS versions_digest ON versions (digest);
+CREATE INDEX IF NOT EXISTS versions_first ON versions (first_snapshot);
+CREATE INDEX IF NOT EXISTS versions_last ON versions (last_snapshot);
+CREATE INDEX IF NOT EXISTS paths_name ON paths (name);
+"""
+
+
+def open_catalogue(fpn, digest='md5'):
+    """
+    Open (or create) a catalogue database.
+
+    Parameters
+    ----------
+    fpn : str
+        Catalogue file (SQLite database).
+    digest : str, optional
+        Digest stored in a new catalogue. Ignored for an existing catalogue,
+        which keeps its digest. The default is 'md5'.
+
+    Returns
+    -------
+    con : sqlite3.Connection
+    digest : str
+        Digest stored in the catalogue.
+    """
+    con = sqlite3.connect(fpn)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.execute('PRAGMA foreign_keys=ON')
+    with con:
+        con.executescript(SCHEMA)
+        con.execute("INSERT OR IGNORE INTO meta VALUES ('digest', ?)",
+                    (digest,))
+        con.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)",
+                    (__version__,))
+    digest = con.execute("SELECT value FROM meta WHERE key = 'digest'"
+                         ).fetchone()[0]
+    return con, digest
+
+
+def ingest(con, digest, fpn):
+    """
+    Ingest a superhash file into the catalogue, as a new snapshot.
+
+    The data lines are loaded into a temporary table, in batches of
+    BATCHSIZE lines. This table is then compared with the versions of the
+    files that were present in the previous snapshot of the same source
+    directory. Versions of files that changed or disappeared are closed
+    (their last snapshot is set to the previous snapshot), and new versions
+    are added for new and changed files. Unchanged files are not written.
+    The snapshot is ingested in a single transaction, so that an
+    interrupted ingest leaves the catalogue unchanged.
+
+    Snapshots of the same source directory must be ingested in
+    chronological order.
+
+    Returns
+    -------
+    stats : dict
+        Numbers of files in the snapshot ('files'), of new versions
+        ('added') and of closed versions ('closed'). None if the snapshot
+        was already in the catalogue.
+    """
+    with open_superhash(fpn) as fin:
+        headerlines, digests = read_header(tsv_reader(fin))
+        header = {ln[0][2:]: ln[1] for ln in headerlines if len(ln) == 2}
+        started = header.get('superhash-start-timestamp-iso')
+        source_dir = header.get('absolute-path-source-dir')
+        if (started is None) or (source_dir is None):
+            raise Exception(f'Not a superhash file "{fpn}"')
+        if not (digest in digests):
+            raise Exception(f'No {digest} digests in "{fpn}"')
+        digestix = 5 + digests.index(digest)
+
+        with con:
+            con.execute('INSERT OR IGNORE INTO series (source_dir) VALUES (?)',
+                        (source_dir,))
+            series_id = con.execute('SELECT id FROM series'
+                                    ' WHERE source_dir = ?',
+                                    (source_dir,)).fetchone()[0]
+            if con.execute('SELECT 1 FROM snapshots WHERE series_id = ? AND'
+                           ' started = ?', (series_id, started)).fetchone():
+                return None
+            prev = con.execute('SELECT id, started FROM snapshots'
+                               ' WHERE series_id = ?'
+                               ' ORDER BY started DESC LIMIT 1',
+                               (series_id,)).fetchone()
+            if (prev is not None) and (prev[1] > started):
+                raise Exception(f'Snapshot "{fpn}" is older than the latest'
+                                ' snapshot of the same source directory'
+                                ' in the catalogue ('+prev[1]+')')
+            snapshot_id = con.execute(
+                'INSERT INTO snapshots (series_id, started, filename,'
+                ' version) VALUES (?, ?, ?, ?)',
+                (series_id, started, os.path.basename(fpn),
+                 header.get('superhash-version'))).lastrowid
+
+            con.execute('DROP TABLE IF EXISTS temp.incoming')
+            con.execute('CREATE TEMP TABLE incoming (dir TEXT, name TEXT,'
+                        ' size INTEGER, mtime TEXT, digest TEXT)')
+            complete = False
+            nfiles = 0
+            nbytes = 0
+            batch = []
+            for rawln in tqdm(iter_tsv_lines(fin, endmarker=True),
+                              unit='line'):
+                if rawln[0] == '#END-SUPERHASH-TSV':
+                    complete = True
+                    break
+                if rawln[digestix] == '!FILE_GONE':
+                    continue
+                nfiles += 1
+                nbytes += int(rawln[4])
+                batch.append((clean_posix(rawln[1]), rawln[2], int(rawln[4]),
+                              rawln[3], rawln[digestix] or None))
+                if len(batch) >= BATCHSIZE:
+                    con.executemany('INSERT INTO incoming'
+                                    ' VALUES (?, ?, ?, ?, ?)', batch)
+                    batch = []
+            con.executemany('INSERT INTO incoming VALUES (?, ?, ?, ?, ?)',
+                            batch)
+            if not complete:
+                raise Exception(f'Superhash file "{fpn}" is incomplete')
+            con.execute('CREATE INDEX temp.incoming_path'
+                        ' ON incoming (dir, name)')
+            con.execute('INSERT OR IGNORE INTO paths (dir, name)'
+                        ' SELECT dir, name FROM incoming')
+            Nclosed = 0
+            if prev is not None:
+                # changed and disappeared files
+                Nclosed = con.execute(
+                    'UPDATE versions SET last_snapshot = ?'
+                    ' WHERE series_id = ? AND last_snapshot IS NULL'
+                    ' AND NOT EXISTS (SELECT 1 FROM incoming i'
+                    '   JOIN paths p ON p.dir = i.dir AND p.name = i.name'
+                    '   WHERE p.id = versions.path_id'
+                    '   AND i.size IS versions.size'
+                    '   AND i.mtime IS versions.mtime'
+                    '   AND i.digest IS versions.digest)',
+                    (prev[0], series_id)).rowcount
+            # new and changed files
+            Nadded = con.execute(
+                'INSERT OR IGNORE INTO versions (series_id, path_id, size,'
+                ' mtime, digest, first_snapshot)'
+                ' SELECT ?, p.id, i.size, i.mtime, i.digest, ?'
+                ' FROM incoming i'
+                ' JOIN paths p ON p.dir = i.dir AND p.name = i.name'
+                ' WHERE NOT EXISTS (SELECT 1 FROM versions v'
+                '   WHERE v.series_id = ? AND v.path_id = p.id'
+                '   AND v.last_snapshot IS NULL)',
+                (series_id, snapshot_id, series_id)).rowcount
+            con.execute('UPDATE snapshots SET nfiles = ?, nbytes = ?,'
+                        ' ingested = ? WHERE id = ?',
+                        (nfiles, nbytes, datetime.now().isoformat(),
+                         snapshot_id))
+            con.execute('DROP TABLE temp.incoming')
+    return {'files': nfiles, 'added': Nadded, 'closed': Nclosed}
+
+
+def snapshot_at(con, timestamp):
+    """
+    For each series (source directory), the latest snapshot taken at or
+    before timestamp (ISO format). Returns a list of (series_id, snapshot_id).
+    """
+    return con.execute('SELECT series_id, MAX(started), id FROM snapshots'
+                       ' WHERE started <= ? GROUP BY series_id',
+                       (timestamp,)).fetchall()
+
+
+def path_condition(path):
+    """
+    SQL condition (and parameters) selecting a file, or all files in a
+    directory and its sub-directories, by their cleaned POSIX path.
+    """
+    path = path.strip('/')
+    parent, _, name = path.rpartition('/')
+    # [path, path+'0') are the paths starting with path+'/'
+    return ('((p.dir = ? AND p.name = ?) OR p.dir = ?'
+            ' OR (p.dir >= ? AND p.dir < ?))',
+            (parent, name, path, path+'/', path+'0'))
+
+
+VERSION_QUERY = """
+SELECT s.source_dir, p.dir, p.name, v.size, v.mtime, v.digest,
+       f.started, l.started,
+       (SELECT MIN(n.started) FROM snapshots n
+        WHERE n.series_id = v.series_id AND n.started > l.started)
+FROM versions v
+JOIN paths p ON p.id = v.path_id
+JOIN series s ON s.id = v.series_id
+JOIN snapshots f ON f.id = v.first_snapshot
+LEFT JOIN snapshots l ON l.id = v.last_snapshot
+"""
+
+
+def print_versions(rows):
+    """
+    Print versions of files: source directory, path, size, mtime, digest,
+    first and last snapshot in which the version was present, and the
+    first snapshot in which it was no longer present ('current' if it is
+    present in the latest snapshot).
+    """
+    for row in rows:
+        path = row[1]+'/'+row[2] if row[1] else row[2]
+        if row[7] is None:
+            last, gone = 'current', ''
+        else:
+            last, gone = row[7], row[8] or ''
+        print('\t'.join([row[0], path, str(row[3]), row[4], row[5] or '',
+                         row[6], last, gone]))
+
+
+#%% main program
+
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("catalogue", type=str,
+                     help="catalogue file (SQLite database)")
+    cli.add_argument("-i", "--ingest", type=str, nargs='+', metavar='FILE',
+                     help="superhash files to add to the catalogue, in"
+                          " chronological order for each source directory")
+    cli.add_argument("--digest-name", type=str, default='md5',
+                     help="digest stored in a new catalogue (default: md5)")
+    cli.add_argument("-l", "--list", action='store_true',
+                     help="list the snapshots in the catalogue")
+    cli.add_argument("-p", "--path", type=str,
+                     help="history of a file, or of all files in a directory"
+                          " (path relative to the source directory)")
+    cli.add_argument("-d", "--digest", type=str, metavar='HEX',
+                     help="all versions of files with this digest")
+    cli.add_argument("-t", "--at", type=str, metavar='TIMESTAMP',
+                     help="files present in the latest snapshot taken at or"
+                          " before TIMESTAMP (ISO format), optionally within"
+                          " --path")
+    clargs = cli.parse_args()
+
+    print('')
+    print("MANBAMM's superhash-catalogue - v"+__version__+\
+          " - by M.H.V. Werts, 2022-2026")
+    print("")
+
+    if (clargs.ingest is None) and not (clargs.list or clargs.path or
+                                        clargs.digest or clargs.at):
+        print('Error: nothing to do, use --ingest, --list, --path,'
+              ' --digest or --at')
+        exit(2)
+    if (clargs.ingest is None) and not os.path.isfile(clargs.catalogue):
+        print('Error: catalogue file not found')
+        exit(2)
+
+    con, digest = open_catalogue(clargs.catalogue, clargs.digest_name)
+    print('Catalogue        :', clargs.catalogue)
+    print('Digest           :', digest)
+    print('')
+
+    if clargs.ingest is not None:
+        print('Ingest superhash files')
+        print('======================')
+        for fpn in clargs.ingest:
+            print(fpn)
+            try:
+                stats = ingest(con, digest, fpn)
+            except Exception as e:
+                print('Error:', e)
+                exit(2)
+            if stats is None:
+                print('    already in catalogue, skipped')
+            else:
+                print('    {0:d} files, {1:d} new versions, {2:d} versions'
+                      ' closed'.format(stats['files'], stats['added'],
+                                       stats['closed']))
+        print('')
+
+    if clargs.list:
+        print('Snapshots')
+        print('=========')
+        for row in con.execute('SELECT s.source_dir, n.started, n.filename,'
+                               ' n.nfiles, n.nbytes FROM snapshots n'
+                               ' JOIN series s ON s.id = n.series_id'
+                               ' ORDER BY s.source_dir, n.started'):
+            print('\t'.join([row[0], row[1], row[2], str(row[3]),
+                             str(row[4])]))
+        print('')
+
+    if clargs.path and not clargs.at:
+        print('History of', clargs.path)
+        print('===========' + '='*len(clargs.path))
+        cond, params = path_condition(clargs.path)
+        print_versions(con.execute(VERSION_QUERY+' WHERE '+cond+
+                                   ' ORDER BY s.source_dir, p.dir, p.name,'
+                                   ' f.started', params))
+        print('')
+
+    if clargs.digest:
+        print('Files with digest', clargs.digest)
+        print('==================' + '='*len(clargs.digest))
+        print_versions(con.execute(VERSION_QUERY+' WHERE v.digest = ?'
+                                   ' ORDER BY s.source_dir, p.dir, p.name,'
+                                   ' f.started',
+                                   (clargs.digest.lower(),)))
+        print('')
+
+    if clargs.at:
+        print('Files present at', clargs.at)
+        print('=================' + '='*len(clargs.at))
+        if clargs.path:
+            cond, params = path_condition(clargs.path)
+        else:
+            cond, params = '1', ()
+        for series_id, started, snapshot_id in snapshot_at(con, clargs.at):
+            print_versions(con.execute(
+                VERSION_QUERY+' WHERE v.series_id = ? AND f.started <= ?'
+                ' AND (l.started IS NULL OR l.started >= ?) AND '+cond+
+                ' ORDER BY p.dir, p.name',
+                (series_id, started, started) + params))
+        print('')
+
+    con.close()
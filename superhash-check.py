@@ -10,51 +10,319 @@
 #
 # 
 
-__version__ = '0.1a3'
+__version__ = '0.6'
 
 import argparse
+import os
+import hashlib
+import heapq
+from itertools import groupby
+from collections import Counter, deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+                               wait, FIRST_COMPLETED
+from array import array
 from pathlib import PurePosixPath
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 
 from tqdm import tqdm
 
+from superhash_format import is_compressed, open_superhash, tsv_reader, \
+                             read_header, iter_rawlines, clean_posix, \
+                             quick_digest
+
 #%% classes and functions
 
-DROPPATHPARTS = 1 # Number of intial parts of the path to drop (ideally, 1)
+CHUNKS_PER_JOB = 4 # TSV block split in this many chunks per job for parsing
+CHUNKSIZE = 16777216 # 16 MiB chunks for re-hashing files (--verify-tree)
+
+# timestamps are stored as (naive) microseconds since this epoch
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def iso_to_us(iso):
+    """ISO timestamp to microseconds since EPOCH"""
+    return (datetime.fromisoformat(iso) - EPOCH) // MICROSECOND
+
+
+def us_to_datetime(us):
+    return EPOCH + timedelta(microseconds=us)
+
+
+def parse_lines(rawlines, digestsizes):
+    """
+    Parse data lines of a superhash file into compact columns.
+
+    Parameters
+    ----------
+    rawlines : iterable of list of str
+        Data lines, split into fields.
+    digestsizes : list of int
+        Size of each digest (bytes). 0 for digests that are kept as text.
+
+    Returns
+    -------
+    cols : dict
+        'dirs': list of the (raw) directory paths, 'dirix': index in 'dirs'
+        for each line, 'fnames', 'timestamps' and 'mtimes' (microseconds
+        since EPOCH), 'sizes', 'digestdata' (a bytearray of binary digests
+        for each digest), 'specials' ((digest, line) -> digest field that is
+        not a hexadecimal digest) and 'N' (number of lines).
+    """
+    dirs = []
+    dirids = {}
+    dirix = array('q')
+    fnames = []
+    timestamps = array('q')
+    mtimes = array('q')
+    sizes = array('q')
+    digestdata = [bytearray() for digestsize in digestsizes]
+    specials = {}
+    ix = 0
+    for rawln in rawlines:
+        dirid = dirids.get(rawln[1])
+        if dirid is None:
+            dirid = dirids[rawln[1]] = len(dirs)
+            dirs.append(rawln[1])
+        dirix.append(dirid)
+        fnames.append(rawln[2])
+        timestamps.append(iso_to_us(rawln[0]))
+        mtimes.append(iso_to_us(rawln[3]))
+        sizes.append(int(rawln[4]))
+        for k, hexdigest in enumerate(rawln[5:5+len(digestsizes)]):
+            digestsize = digestsizes[k]
+            try:
+                digest = bytes.fromhex(hexdigest)
+            except ValueError:
+                digest = b''
+            if (len(digest) != digestsize) or (digestsize == 0):
+                digest = bytes(digestsize)
+                specials[(k, ix)] = hexdigest
+            digestdata[k] += digest
+        ix += 1
+    return {'dirs': dirs, 'dirix': dirix, 'fnames': fnames,
+            'timestamps': timestamps, 'mtimes': mtimes, 'sizes': sizes,
+            'digestdata': digestdata, 'specials': specials, 'N': ix}
+
+
+def parse_tsv_chunk(fpn, start, stop, digestsizes):
+    """
+    Parse the data lines in a byte range of a superhash file (in a worker
+    process). start and stop should be at the start of a line.
+
+    Returns
+    -------
+    cols : dict
+        Columns, as returned by parse_lines().
+    complete : bool
+        False if the end of the TSV block was found in this chunk, in which
+        case the following chunks should not be used.
+    """
+    with open(fpn, 'rb') as fin:
+        fin.seek(start)
+        data = fin.read(stop - start)
+    return parse_tsv_data(data, digestsizes)
+
+
+def parse_tsv_data(data, digestsizes):
+    """
+    Parse the data lines in a block of (complete) lines of a superhash file
+    (in a worker process). Returns the same as parse_tsv_chunk().
+    """
+    lines = data.decode('utf-8').split('\n')
+    if not lines[-1]:
+        lines.pop()
+    rawlines = [line.rstrip('\r').split('\t') for line in lines]
+    # iter_rawlines() stops at the end of the TSV block: detect this from
+    # the last line it has consumed
+    consumed = 0
+    def counted():
+        nonlocal consumed
+        for rawln in rawlines:
+            consumed += 1
+            yield rawln
+    cols = parse_lines(iter_rawlines(counted()), digestsizes)
+    complete = True
+    if consumed > 0:
+        last = rawlines[consumed-1]
+        complete = not ((last[0] == '#END-SUPERHASH-TSV') or
+                        (not last[0].startswith('#') and (len(last) < 6)))
+    return cols, complete
+
+
+def parse_tsv_parallel(fpn, digestsizes, jobs):
+    """
+    Parse the data lines of a superhash file in a pool of jobs processes.
+
+    The TSV block is split into byte ranges at line boundaries. The ranges
+    are parsed concurrently, and the results are combined in the original
+    order into the columns returned by parse_lines().
+
+    Compressed files cannot be split. They are decompressed in the main
+    process, and blocks of CHUNKSIZE bytes of lines are sent to the
+    processes for parsing.
+    """
+    def tasks():
+        if is_compressed(fpn):
+            with open_superhash(fpn, 'rb') as fin:
+                for line in fin:
+                    if line.startswith(b'# timestamp_iso'):
+                        break
+                while True:
+                    data = fin.read(CHUNKSIZE)
+                    if not data:
+                        break
+                    data += fin.readline()
+                    yield parse_tsv_data, (data, digestsizes)
+            return
+        with open(fpn, 'rb') as fin:
+            for line in fin:
+                if line.startswith(b'# timestamp_iso'):
+                    break
+            start = fin.tell()
+            end = fin.seek(0, os.SEEK_END)
+            Nchunks = jobs*CHUNKS_PER_JOB
+            bounds = [start]
+            for i in range(1, Nchunks):
+                fin.seek(max(bounds[-1], start + (end - start)*i//Nchunks))
+                fin.readline()
+                if fin.tell() < end:
+                    bounds.append(fin.tell())
+            bounds.append(end)
+        for bstart, bstop in zip(bounds[:-1], bounds[1:]):
+            yield parse_tsv_chunk, (fpn, bstart, bstop, digestsizes)
+
+    def results(pool):
+        # a limited number of chunks is submitted ahead
+        pending = deque()
+        for func, args in tasks():
+            pending.append(pool.submit(func, *args))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    cols = None
+    dirids = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for chunk, complete in results(pool):
+            if cols is None:
+                cols = chunk
+                dirids = {d: dirid for dirid, d in enumerate(cols['dirs'])}
+            else:
+                # directory indices of the chunk -> those of the index
+                dirmap = []
+                for d in chunk['dirs']:
+                    dirid = dirids.get(d)
+                    if dirid is None:
+                        dirid = dirids[d] = len(cols['dirs'])
+                        cols['dirs'].append(d)
+                    dirmap.append(dirid)
+                cols['dirix'].extend(dirmap[dirid] for dirid in chunk['dirix'])
+                for key in ['fnames', 'timestamps', 'mtimes', 'sizes']:
+                    cols[key] += chunk[key]
+                for k, data in enumerate(chunk['digestdata']):
+                    cols['digestdata'][k] += data
+                for (k, ix), special in chunk['specials'].items():
+                    cols['specials'][(k, cols['N'] + ix)] = special
+                cols['N'] += chunk['N']
+            if not complete:
+                pool.shutdown(wait=True, cancel_futures=True)
+                break
+    if cols is None:
+        cols = parse_lines([], digestsizes)
+    return cols
+
 
 class SuperhashIndex:
-    def __init__(self, fpn):
-        with open(fpn, 'r', encoding='utf-8') as fin:
-            rdr = csv.reader(fin, delimiter='\t', quoting=csv.QUOTE_NONE)
-            self.header = [rdr.__next__() for i in range(5)]
-            if not (self.header[0][0] == '# superhash-version'):
-                raise Exception('Not a superhash file')
-            if not (self.header[0][1] == __version__):
-                print('*** WARNING! File generated with a different version of superhash ***')
-                print('    File generated with v'+self.header[0][1]+', current software v'+__version__)
-            self.lines = []
-            for rawln in rdr:
-                cleanpath = PurePosixPath(*PurePosixPath(\
-                                               rawln[1]).parts[DROPPATHPARTS:])
-                ln = [datetime.fromisoformat(rawln[0]),
-                      cleanpath,
-                      rawln[2],
-                      datetime.fromisoformat(rawln[3]),
-                      int(rawln[4]),
-                      rawln[5]]
-                self.lines.append(ln)
+    """
+    In-memory index of a superhash file, stored in a compact, columnar form.
+
+    Directory paths are stored only once (self.dirs), and referred to by
+    their index for each line (self.dirix). Timestamps (as microseconds since
+    EPOCH) and sizes are stored in arrays of 64-bit integers. Digests are
+    stored in binary form, in one bytearray per digest. Digest fields that
+    are not hexadecimal digests (e.g. '!FILE_GONE', or empty with 'nohash')
+    are kept in self.specials. datetime and PurePosixPath objects are only
+    created when a line is accessed with line().
+
+    Files in the v0.1 format (5-line header) as well as later formats (with
+    or without the JSONL walklist block) can be read.
+
+    With jobs > 1, the data lines are parsed in a pool of jobs processes.
+    """
+    def __init__(self, fpn, jobs=1):
+        with open_superhash(fpn) as fin:
+            rdr = tsv_reader(fin)
+            self.header, self.digests = read_header(rdr)
+            self.digestsizes = []
+            for name in self.digests:
+                try:
+                    # the 'quick' fingerprint is an MD5 digest
+                    self.digestsizes.append(hashlib.new(
+                        'md5' if (name == 'quick') else name).digest_size)
+                except ValueError:
+                    # unknown digest: keep as text in self.specials
+                    self.digestsizes.append(0)
+            if jobs <= 1:
+                cols = parse_lines(iter_rawlines(rdr), self.digestsizes)
+        if jobs > 1:
+            cols = parse_tsv_parallel(fpn, self.digestsizes, jobs)
+        # cleaned directory paths (POSIX)
+        self.dirs = [clean_posix(d) for d in cols['dirs']]
+        self.dirix = cols['dirix']
+        self.fnames = cols['fnames']
+        self.timestamps = cols['timestamps']
+        self.mtimes = cols['mtimes']
+        self.sizes = cols['sizes']
+        self.digestdata = cols['digestdata']
+        self.specials = cols['specials']
         self.shfilename = fpn
         self.seqsrchix = 0
-        self.Nlines = len(self.lines)
+        self.Nlines = cols['N']
+        # hashed index: (path, filename) -> line index, built when needed
+        self.index = None
+
+    def dir(self, ix):
+        """Cleaned directory path (POSIX) of line ix"""
+        return self.dirs[self.dirix[ix]]
+
+    def rawdigest(self, k, ix):
+        """
+        Digest k (index in self.digests) of line ix, as bytes, or as a str
+        if it is not a hexadecimal digest (e.g. '!FILE_GONE').
+        """
+        special = self.specials.get((k, ix))
+        if special is not None:
+            return special
+        digestsize = self.digestsizes[k]
+        return bytes(self.digestdata[k][ix*digestsize:(ix+1)*digestsize])
+
+    def line(self, ix):
+        """
+        Line ix, as a list: timestamp (datetime), path (PurePosixPath),
+        filename, mtime (datetime), size, followed by the hexadecimal
+        digests.
+        """
+        ln = [us_to_datetime(self.timestamps[ix]),
+              PurePosixPath(self.dir(ix)),
+              self.fnames[ix],
+              us_to_datetime(self.mtimes[ix]),
+              self.sizes[ix]]
+        for k in range(len(self.digests)):
+            digest = self.rawdigest(k, ix)
+            ln.append(digest if isinstance(digest, str) else digest.hex())
+        return ln
                 
     def print_stats(self):
-        totalbytes = 0
-        for ln in self.lines:
-            totalbytes += ln[4]
-        td = self.lines[-1][0] - self.lines[0][0]
-        totaltime = td.total_seconds()
-        throughp = totalbytes/(1e6*totaltime)
+        totalbytes = sum(self.sizes)
+        if self.Nlines > 0:
+            totaltime = (self.timestamps[-1] - self.timestamps[0])/1e6
+        else:
+            totaltime = 0.0
+        throughp = totalbytes/(1e6*totaltime) if (totaltime > 0) else 0.0
         print('Superhash file   :', self.shfilename)
         print('Generated on     :', self.header[1][1])
         print('Source directory :', self.header[2][1][:50])
@@ -65,14 +333,14 @@ class SuperhashIndex:
         print('Throughput       : {0:.3f} MB/s'.format(throughp))
         print('')
         
-    def seqsearch(self, path, fname):
+    def search(self, path, fname):
         """
         Search for the line containing info for path, fname
 
         Parameters
         ----------
-        path : pathlib.PurePath
-            Path to be found.
+        path : str
+            Path to be found (cleaned, POSIX, '' for the top directory).
         fname : str
             Filename to be found.
 
@@ -82,110 +350,1088 @@ class SuperhashIndex:
             Index of the line containing info for path, fname.
             Returns None if not found
             
-        This implements a sequential search, which restarts at the last line
-        after the line where a successful match was found. This makes subsequent
-        searches highly efficient, since both SuperhashIndexes (superhash files)
-        are expected to be 'in sync' over extended portions, even completely
-        'in sync', thanks to sorting the os.walk() stuff.
+        First, the line following the previous successful match is tried.
+        Both SuperhashIndexes (superhash files) are expected to be 'in sync'
+        over extended portions, even completely 'in sync', thanks to sorting
+        the directory tree, so this is usually the line sought. If not, the
+        line is looked up in the hashed index, first with the full path, then
+        with its parents (a line matches if path is relative to its path).
+        A lookup takes constant time, independent of the order of the files.
+        The hashed index is only built when it is needed for the first time.
         """
         foundix = None
         ix = self.seqsrchix
-        while True:
-            if fname == self.lines[ix][2]:
-                if path.is_relative_to(self.lines[ix][1]):
-                    foundix = ix
-            ix += 1
-            if (ix == self.Nlines):
-                ix = 0
-            if ix == self.seqsrchix:
-                break
-            if foundix is not None:
-                break
-        self.seqsrchix = ix
+        if (ix < self.Nlines) and (fname == self.fnames[ix]) and \
+           (path == self.dir(ix)):
+            foundix = ix
+        else:
+            if self.index is None:
+                self.index = {}
+                for ix in range(self.Nlines):
+                    self.index.setdefault((self.dirix[ix], self.fnames[ix]),
+                                          ix)
+                self.dirids = {d: dirid for dirid, d in enumerate(self.dirs)}
+            parent = path
+            while True:
+                dirid = self.dirids.get(parent)
+                if dirid is not None:
+                    foundix = self.index.get((dirid, fname))
+                    if foundix is not None:
+                        break
+                if not parent:
+                    break
+                parent = parent.rpartition('/')[0]
+        if foundix is not None:
+            self.seqsrchix = foundix + 1
+            if (self.seqsrchix == self.Nlines):
+                self.seqsrchix = 0
         return foundix
+
+    def content_index(self, k):
+        """
+        Build a content-addressed index over the lines, in a single pass.
+
+        Parameters
+        ----------
+        k : int
+            Index (in self.digests) of the digest to use.
+
+        Returns
+        -------
+        cindex : dict
+            (size, digest) -> list of line indices with that content.
+            Lines without a valid digest (e.g. '!FILE_GONE') are left out.
+        """
+        cindex = {}
+        for ix in range(self.Nlines):
+            digest = self.rawdigest(k, ix)
+            if isinstance(digest, str):
+                continue
+            cindex.setdefault((self.sizes[ix], digest), []).append(ix)
+        return cindex
+
+
+def classify_missing(sh1, sh2, k1, k2, lmissing, matched):
+    """
+    Classify the lines of File #2 that were not found in File #1.
+
+    The lines of File #1 with the same content (size and digest) are looked
+    up in a content-addressed index over File #1. A line of File #1 that was
+    not matched by any line in File #2 has disappeared from its original
+    location, and is taken to be the source of a move or rename. Each
+    disappeared line can be the source of only one move or rename, further
+    copies of the same content are duplicates.
+
+    Parameters
+    ----------
+    sh1, sh2 : SuperhashIndex
+        File #1 and File #2.
+    k1, k2 : int
+        Index of the digest used for comparison in sh1.digests, sh2.digests.
+    lmissing : list of int
+        Indices of the lines of File #2 not found in File #1.
+    matched : bytearray
+        Non-zero for each line of File #1 that was found in File #2.
+
+    Returns
+    -------
+    classified : list of tuple
+        (status, ix1, ix2) for each line ix2 in lmissing, where status is
+        'moved' (other directory), 'renamed' (same directory, other
+        filename), 'duplicated' (copy of a file still present in File #2)
+        or 'new' (content not present in File #1). ix1 is the line of
+        File #1 with the same content, or None for 'new'.
+    """
+    cindex = sh1.content_index(k1)
+    claimed = bytearray(sh1.Nlines)
+    classified = []
+    for ix2 in lmissing:
+        digest = sh2.rawdigest(k2, ix2)
+        candidates = [] if isinstance(digest, str) else \
+                     cindex.get((sh2.sizes[ix2], digest), [])
+        if not candidates:
+            classified.append(('new', None, ix2))
+            continue
+        dir2 = sh2.dir(ix2)
+        fname2 = sh2.fnames[ix2]
+        sources = [ix1 for ix1 in candidates
+                   if not (matched[ix1] or claimed[ix1])]
+        if not sources:
+            classified.append(('duplicated', candidates[0], ix2))
+            continue
+        # prefer a source with the same filename, then the same directory
+        ix1 = next((ix1 for ix1 in sources if sh1.fnames[ix1] == fname2),
+                   next((ix1 for ix1 in sources if sh1.dir(ix1) == dir2),
+                        sources[0]))
+        claimed[ix1] = 1
+        if sh1.dir(ix1) == dir2:
+            classified.append(('renamed', ix1, ix2))
+        else:
+            classified.append(('moved', ix1, ix2))
+    return classified
             
 
         
 
+def common_digests(fpns):
+    """
+    Names of the digests present in all superhash files fpns, in the order
+    of the first file. Only the headers of the files are read.
+    """
+    digestlists = []
+    for fpn in fpns:
+        with open_superhash(fpn) as fin:
+            digestlists.append(read_header(tsv_reader(fin))[1])
+    return [name for name in digestlists[0]
+            if all(name in dl for dl in digestlists)]
+
+
+def no_common_digest():
+    """Report that the files have no digest in common, and exit"""
+    print('Error: the files do not have any digest in common')
+    print('       To check a directory tree against an index file that'
+          ' only has quick')
+    print('       fingerprints, use --verify-tree DIR --quick')
+    exit(2)
+
+
+def iter_sorted(rawlines, fileno):
+    """
+    Yield (key, rawln) for the lines of a superhash file, with key the
+    tuple of cleaned path and filename. Checks that the keys are in
+    strictly ascending order, as required for stream_compare().
+    """
+    prevkey = None
+    for rawln in rawlines:
+        key = (clean_posix(rawln[1]), rawln[2])
+        if (prevkey is not None) and not (key > prevkey):
+            raise Exception(f'File #{fileno:d} is not in sorted order at "'
+                            +'/'.join(key)+'". Compare without --stream.')
+        prevkey = key
+        yield key, rawln
+
+
+def stream_compare(fpn1, fpn2, wrtmiss=None):
+    """
+    Compare two superhash files in a single sequential pass (merge-join).
+
+    Both files are read line by line at the same time, so memory use does
+    not depend on their length. This requires the lines to be sorted by
+    path and filename, which is the case for files generated by
+    superhash v0.3 and later. Paths are matched exactly.
+
+    Parameters
+    ----------
+    fpn1, fpn2 : str
+        Superhash files #1 and #2.
+    wrtmiss : csv.writer, optional
+        Writer for the lines of File #2 that are not in File #1.
+
+    Returns
+    -------
+    counts : dict
+        Numbers of lines in File #2 not found in File #1 ('notfound'), of
+        lines in File #1 not in File #2 ('notinfile2'), of lines with
+        different digests ('errors'), and of lines with identical digests
+        but different size ('sizedrift') or mtime ('mtimedrift').
+
+    """
+    counts = dict.fromkeys(['notfound', 'notinfile2', 'errors',
+                            'sizedrift', 'mtimedrift'], 0)
+    with open_superhash(fpn1) as fin1, open_superhash(fpn2) as fin2:
+        rdr1 = tsv_reader(fin1)
+        rdr2 = tsv_reader(fin2)
+        header1, digests1 = read_header(rdr1)
+        header2, digests2 = read_header(rdr2)
+        for fileno, fpn, header in [(1, fpn1, header1), (2, fpn2, header2)]:
+            print(f'FILE #{fileno:d}          :', fpn)
+            print('Generated on     :', header[1][1])
+            print('Source directory :', header[2][1][:50])
+        print('')
+
+        digests = [name for name in digests2 if name in digests1]
+        if not digests:
+            raise Exception('The files do not have any digest in common')
+        digestix1 = [5+digests1.index(name) for name in digests]
+        digestix2 = [5+digests2.index(name) for name in digests]
+        print('Comparing digests:', ', '.join(digests))
+        print('')
+
+        lines1 = iter_sorted(iter_rawlines(rdr1), 1)
+        lines2 = iter_sorted(iter_rawlines(rdr2), 2)
+        key1, ln1 = next(lines1, (None, None))
+        key2, ln2 = next(lines2, (None, None))
+        pbar = tqdm(unit='line')
+        while (ln1 is not None) or (ln2 is not None):
+            pbar.update()
+            if (ln2 is None) or ((ln1 is not None) and (key1 < key2)):
+                counts['notinfile2'] += 1
+                key1, ln1 = next(lines1, (None, None))
+                continue
+            if (ln1 is None) or (key2 < key1):
+                counts['notfound'] += 1
+                if wrtmiss is not None:
+                    wrtmiss.writerow([ln2[0], key2[0] or '.'] + ln2[2:])
+                key2, ln2 = next(lines2, (None, None))
+                continue
+            baddigests = [name for name, ix1, ix2
+                          in zip(digests, digestix1, digestix2)
+                          if not ln2[ix2] == ln1[ix1]]
+            if baddigests:
+                tqdm.write('Checksum error ({0:s}): "{1:s}"'.\
+                           format(','.join(baddigests), '/'.join(key2)))
+                counts['errors'] += 1
+            elif not (ln2[4] == ln1[4]):
+                tqdm.write('Size differs: "{0:s}"'.format('/'.join(key2)))
+                counts['sizedrift'] += 1
+            elif not (ln2[3] == ln1[3]):
+                counts['mtimedrift'] += 1
+            key1, ln1 = next(lines1, (None, None))
+            key2, ln2 = next(lines2, (None, None))
+        pbar.close()
+    return counts
+
+
+def read_directory_digests(fpn):
+    """
+    Read the block of directory digests at the end of a superhash file
+    (v0.6 and later), locating it from the '#DIRS-OFFSET' record.
+
+    Raises ValueError if the file has no (valid) block of directory
+    digests.
+
+    Returns
+    -------
+    digestname : str
+        Digest used for the directory digests.
+    dirs : dict
+        Cleaned directory path -> [digest, number of files and total bytes in
+        the subtree, byte offset of the first data line of the directory
+        itself, number of files in the directory itself].
+    children : dict
+        Cleaned directory path -> sorted list of the names of its child
+        directories.
+    """
+    marker = b'\n#DIRS-OFFSET\t'
+    nodirs = f'No directory digests in "{fpn}" (incomplete, or generated' \
+             ' with superhash before v0.6)'
+    with open_superhash(fpn, 'rb') as fin:
+        if is_compressed(fpn):
+            # cannot seek from the end: read up to the block
+            for line in fin:
+                if line.startswith(b'#DIRS\t'):
+                    break
+            else:
+                raise ValueError(nodirs)
+        else:
+            end = fin.seek(0, os.SEEK_END)
+            fin.seek(max(0, end - 4096))
+            tail = fin.read()
+            ix = tail.rfind(marker)
+            if ix < 0:
+                raise ValueError(nodirs)
+            fin.seek(int(tail[ix+len(marker):].split(b'\n', 1)[0]))
+            line = fin.readline()
+        dirsline = line.rstrip(b'\r\n').decode('utf-8').split('\t')
+        if not (dirsline[0] == '#DIRS'):
+            raise ValueError(f'Invalid directory digests in "{fpn}"')
+        dirs = {}
+        children = {}
+        for line in fin:
+            rec = line.rstrip(b'\r\n').decode('utf-8').split('\t')
+            if not (rec[0] == '#DIR'):
+                break
+            path = clean_posix(rec[1])
+            dirs[path] = [rec[2]] + [int(val) for val in rec[3:7]]
+            children[path] = []
+            if path:
+                parent, _, name = path.rpartition('/')
+                children[parent].append(name)
+    return dirsline[1], dirs, children
+
+
+def iter_directory_lines(fin, offset, Nown):
+    """Read the Nown data lines of a directory, starting at offset"""
+    if (Nown == 0) or (offset < 0):
+        # no files in the directory itself
+        return
+    fin.seek(offset)
+    while Nown > 0:
+        line = fin.readline()
+        if not line.endswith(b'\n'):
+            raise Exception('Unexpected end of file reading directory lines')
+        if line.startswith(b'#'):
+            continue
+        Nown -= 1
+        yield line.rstrip(b'\r\n').decode('utf-8').split('\t')
+
+
+def tree_compare(fpn1, fpn2, wrtmiss=None, dirdigests=None):
+    """
+    Compare two superhash files top-down, using the directory digests.
+
+    Subtrees with identical directory digests are skipped. Only the data
+    lines of directories whose digests differ are read, so the work done
+    is proportional to the number of directories and the number of
+    differences, not to the number of files. Paths are matched exactly.
+    Differences in mtime only are not detected in skipped subtrees.
+
+    Parameters
+    ----------
+    fpn1, fpn2 : str
+        Superhash files #1 and #2 (v0.6 or later).
+    wrtmiss : csv.writer, optional
+        Writer for the lines of File #2 that are not in File #1.
+    dirdigests : list, optional
+        The directory digests of both files, as returned by
+        read_directory_digests(), if these have already been read.
+
+    Returns
+    -------
+    counts : dict
+        As returned by stream_compare(), and the numbers of directories
+        compared ('dirs') and of files skipped in identical subtrees
+        ('skipped').
+
+    """
+    counts = dict.fromkeys(['notfound', 'notinfile2', 'errors',
+                            'sizedrift', 'mtimedrift', 'dirs', 'skipped'], 0)
+    digestlists = []
+    for fileno, fpn in [(1, fpn1), (2, fpn2)]:
+        with open_superhash(fpn) as fin:
+            rdr = tsv_reader(fin)
+            header, digests = read_header(rdr)
+        print(f'FILE #{fileno:d}          :', fpn)
+        print('Generated on     :', header[1][1])
+        print('Source directory :', header[2][1][:50])
+        digestlists.append(digests)
+    print('')
+
+    if dirdigests is None:
+        dirdigests = [read_directory_digests(fpn) for fpn in (fpn1, fpn2)]
+    (dirdigest1, dirs1, children1), (dirdigest2, dirs2, children2) = \
+        dirdigests
+    if not (dirdigest1 == dirdigest2):
+        raise Exception('The directory digests of the files use different'
+                        ' digests')
+    digests = [name for name in digestlists[1] if name in digestlists[0]]
+    if not digests:
+        raise Exception('The files do not have any digest in common')
+    digestix1 = [5+digestlists[0].index(name) for name in digests]
+    digestix2 = [5+digestlists[1].index(name) for name in digests]
+    print('Comparing digests:', ', '.join(digests))
+    print('')
+
+    with open_superhash(fpn1, 'rb') as fin1, \
+         open_superhash(fpn2, 'rb') as fin2:
+        def missing_subtree(path):
+            """Report all lines in a subtree that is not in File #1"""
+            counts['notfound'] += dirs2[path][1]
+            if wrtmiss is None:
+                return
+            stack = [path]
+            while stack:
+                path = stack.pop()
+                for ln2 in iter_directory_lines(fin2, *dirs2[path][3:5]):
+                    wrtmiss.writerow([ln2[0], path or '.'] + ln2[2:])
+                stack.extend(path+'/'+name if path else name
+                             for name in reversed(children2[path]))
+
+        pbar = tqdm(unit='dir')
+        stack = ['']
+        if not ('' in dirs2):
+            stack = []
+            if '' in dirs1:
+                counts['notinfile2'] += dirs1[''][1]
+        elif not ('' in dirs1):
+            missing_subtree('')
+            stack = []
+        while stack:
+            path = stack.pop()
+            pbar.update()
+            counts['dirs'] += 1
+            if dirs1[path][0] == dirs2[path][0]:
+                counts['skipped'] += dirs2[path][1]
+                continue
+            lines1 = {ln1[2]: ln1 for ln1
+                      in iter_directory_lines(fin1, *dirs1[path][3:5])}
+            for ln2 in iter_directory_lines(fin2, *dirs2[path][3:5]):
+                ln1 = lines1.pop(ln2[2], None)
+                key2 = path+'/'+ln2[2] if path else ln2[2]
+                if ln1 is None:
+                    counts['notfound'] += 1
+                    if wrtmiss is not None:
+                        wrtmiss.writerow([ln2[0], path or '.'] + ln2[2:])
+                    continue
+                baddigests = [name for name, ix1, ix2
+                              in zip(digests, digestix1, digestix2)
+                              if not ln2[ix2] == ln1[ix1]]
+                if baddigests:
+                    tqdm.write('Checksum error ({0:s}): "{1:s}"'.\
+                               format(','.join(baddigests), key2))
+                    counts['errors'] += 1
+                elif not (ln2[4] == ln1[4]):
+                    tqdm.write('Size differs: "{0:s}"'.format(key2))
+                    counts['sizedrift'] += 1
+                elif not (ln2[3] == ln1[3]):
+                    counts['mtimedrift'] += 1
+            counts['notinfile2'] += len(lines1)
+            names1 = set(children1[path])
+            for name in reversed(children2[path]):
+                child = path+'/'+name if path else name
+                if name in names1:
+                    stack.append(child)
+                else:
+                    missing_subtree(child)
+            for name in names1.difference(children2[path]):
+                child = path+'/'+name if path else name
+                counts['notinfile2'] += dirs1[child][1]
+        pbar.close()
+    return counts
+
+
+def rehash_file(filepath, names):
+    """
+    Calculate the digests of a file. Returns a list of binary digests, or
+    None if the file no longer exists. Other errors (e.g. PermissionError)
+    are raised.
+    """
+    hashers = [hashlib.new(name) for name in names]
+    try:
+        with open(filepath, 'rb') as fin:
+            while True:
+                chunk = fin.read(CHUNKSIZE)
+                if not chunk:
+                    break
+                for hasher in hashers:
+                    hasher.update(chunk)
+    except FileNotFoundError:
+        return None
+    return [hasher.digest() for hasher in hashers]
+
+
+def quick_fingerprint(filepath, fpsize):
+    """
+    Calculate the 'quick' fingerprint of a file, in exactly the same way as
+    superhash.py (see superhash_format.quick_digest()).
+    """
+    with open(filepath, 'rb') as fin:
+        return quick_digest(fin, fpsize).digest()
+
+
+def verify_tree(p_dir, sh, jobs=1, failfast=False, quick=False):
+    """
+    Verify the files in a directory tree against a superhash index.
+
+    The tree is walked, and each file is looked up in the index (exact
+    path). The size is checked first. Only files of the right size are
+    read and hashed, in a pool of jobs threads. Mismatches are reported as
+    soon as they are found.
+
+    With quick, the 'quick' fingerprints are checked first, if the index has
+    them. The full digests are only calculated (escalation) for files of
+    which the fingerprint differs or is missing. Without quick, or for
+    index files without full digests, only the available digests are used.
+
+    Parameters
+    ----------
+    p_dir : str
+        Top directory of the tree.
+    sh : SuperhashIndex
+        Index of the tree.
+    jobs : int
+        Number of files hashed concurrently.
+    failfast : bool
+        Stop at the first mismatch.
+    quick : bool
+        Check the quick fingerprints first.
+
+    Returns
+    -------
+    counts : dict
+        Numbers of files verified ('verified'), of files not in the index
+        ('notfound'), of entries in the index not in the tree ('missing'),
+        of files with different size ('sizeerrors') or digests ('errors'),
+        of files that could not be read ('unreadable', e.g. no permission),
+        of files with identical digests but different mtime ('mtimedrift'),
+        and of files of which the index contains no digest ('nodigest').
+        Of the verified files, 'quick' were verified by their quick
+        fingerprint only, 'escalated' needed the full digests.
+        'stopped' is True if verification stopped at the first failure.
+
+    """
+    counts = dict.fromkeys(['verified', 'notfound', 'missing', 'sizeerrors',
+                            'errors', 'unreadable', 'mtimedrift', 'nodigest',
+                            'quick', 'escalated'], 0)
+    counts['stopped'] = False
+    # digests that can be verified
+    ks = [k for k, digestsize in enumerate(sh.digestsizes) if digestsize > 0]
+    fullks = [k for k in ks if not (sh.digests[k] == 'quick')]
+    quickk = sh.digests.index('quick') if ('quick' in sh.digests) else None
+    seen = bytearray(sh.Nlines)
+
+    def verify_file(filepath, ix, usequick, rowks):
+        """
+        Returns status ('quick', 'full', 'gone', 'error', 'unreadable'), and
+        the bad digests (or the error message, if unreadable)
+        """
+        try:
+            if usequick:
+                if quick_fingerprint(filepath, sh.sizes[ix]) == \
+                   sh.rawdigest(quickk, ix):
+                    return 'quick', []
+                if not rowks:
+                    return 'error', ['quick']
+            digests = rehash_file(filepath, [sh.digests[k] for k in rowks])
+        except FileNotFoundError:
+            digests = None
+        except OSError as exc:
+            return 'unreadable', [exc.strerror or str(exc)]
+        if digests is None:
+            return 'gone', []
+        baddigests = [sh.digests[k] for k, digest in zip(rowks, digests)
+                      if not (sh.rawdigest(k, ix) == digest)]
+        return ('error' if baddigests else 'full'), baddigests
+
+    def failed(message):
+        tqdm.write(message)
+        if failfast:
+            counts['stopped'] = True
+
+    def check_digests(future, ix, relfile, mtime):
+        status, baddigests = future.result()
+        if status == 'gone':
+            counts['missing'] += 1
+            failed('File gone: "{0:s}"'.format(relfile))
+            return
+        if status == 'unreadable':
+            counts['unreadable'] += 1
+            failed('Unreadable ({0:s}): "{1:s}"'.\
+                   format(baddigests[0], relfile))
+            return
+        if status == 'error':
+            counts['errors'] += 1
+            failed('Checksum error ({0:s}): "{1:s}"'.\
+                   format(','.join(baddigests), relfile))
+            return
+        counts['verified'] += 1
+        if status == 'quick':
+            counts['quick'] += 1
+        elif quick:
+            counts['escalated'] += 1
+        if not (mtime == sh.mtimes[ix]):
+            counts['mtimedrift'] += 1
+
+    def files():
+        for dirpath, dirnames, filenames in os.walk(p_dir):
+            dirnames.sort()
+            rel = os.path.relpath(dirpath, p_dir).replace(os.sep, '/')
+            if rel == '.':
+                rel = ''
+            for fname in sorted(filenames):
+                yield os.path.join(dirpath, fname), rel, fname
+
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    pending = {} # future -> (line index, path, mtime)
+    pbar = tqdm(unit='file')
+    try:
+        for filepath, rel, fname in files():
+            pbar.update()
+            relfile = rel+'/'+fname if rel else fname
+            ix = sh.search(rel, fname)
+            if (ix is None) or not (sh.dir(ix) == rel):
+                counts['notfound'] += 1
+                failed('Not in index: "{0:s}"'.format(relfile))
+            else:
+                seen[ix] = 1
+                try:
+                    fpstat = os.stat(filepath)
+                except FileNotFoundError:
+                    fpstat = None
+                except OSError as exc:
+                    counts['unreadable'] += 1
+                    failed('Unreadable ({0:s}): "{1:s}"'.\
+                           format(exc.strerror or str(exc), relfile))
+                    fpstat = False
+                special = sh.specials.get((ks[0], ix)) if ks else ''
+                rowks = [k for k in fullks if (k, ix) not in sh.specials]
+                usequick = (quickk is not None) and \
+                           ((quickk, ix) not in sh.specials) and \
+                           (quick or not rowks)
+                if fpstat is False:
+                    pass
+                elif fpstat is None:
+                    if not (special == '!FILE_GONE'):
+                        counts['missing'] += 1
+                        failed('File gone: "{0:s}"'.format(relfile))
+                elif not (fpstat.st_size == sh.sizes[ix]):
+                    counts['sizeerrors'] += 1
+                    failed('Size differs: "{0:s}"'.format(relfile))
+                elif not (rowks or usequick):
+                    # no digest in the index (e.g. --nohash)
+                    counts['nodigest'] += 1
+                else:
+                    mtime = (datetime.fromtimestamp(fpstat.st_mtime) - EPOCH)\
+                            // MICROSECOND
+                    future = pool.submit(verify_file, filepath, ix, usequick,
+                                         rowks)
+                    pending[future] = (ix, relfile, mtime)
+            # keep a limited number of files queued for hashing
+            while (len(pending) >= 4*jobs) and not counts['stopped']:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    check_digests(future, *pending.pop(future))
+            if counts['stopped']:
+                break
+        while pending and not counts['stopped']:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                check_digests(future, *pending.pop(future))
+    finally:
+        pbar.close()
+        pool.shutdown(wait=True, cancel_futures=True)
+    if not counts['stopped']:
+        for ix in range(sh.Nlines):
+            if not (seen[ix] or
+                    (ks and (sh.specials.get((ks[0], ix)) == '!FILE_GONE'))):
+                counts['missing'] += 1
+                tqdm.write('Missing: "{0:s}"'.format(
+                    sh.dir(ix)+'/'+sh.fnames[ix] if sh.dir(ix)
+                    else sh.fnames[ix]))
+    return counts
+
+
+def nway_compare(fpns, wrtreport=None):
+    """
+    Compare any number of superhash files (replicas) in a single pass.
+
+    The sorted files are read line by line at the same time (k-way merge),
+    so memory use does not depend on their length. Paths are matched
+    exactly. For each entry, the files holding it are compared with each
+    other. If their digests disagree, the file(s) not having the digest
+    held by the majority of the files are the 'odd one(s) out'.
+
+    Parameters
+    ----------
+    fpns : list of str
+        Superhash files.
+    wrtreport : csv.writer, optional
+        Writer for the entries on which the files do not agree: path,
+        filename, the status for each file ('ok', 'missing' or 'differs')
+        and the numbers of the odd files out (empty if there is no majority).
+
+    Returns
+    -------
+    stats : dict
+        Numbers of entries ('entries'), of entries held by all files with
+        identical digests ('agree'), of entries missing in some of the files
+        ('incomplete'), of entries with disagreeing digests ('errors'); for
+        each file, the number of entries held ('held'), missing ('missing'),
+        and for which it is the odd one out ('odd'); and the agreement
+        matrix ('pairs'): the number of entries held by both files with
+        identical digests, for each pair of files.
+
+    """
+    N = len(fpns)
+    with ExitStack() as stack:
+        rdrs = []
+        digestlists = []
+        for fileno, fpn in enumerate(fpns, start=1):
+            fin = stack.enter_context(open_superhash(fpn))
+            rdr = tsv_reader(fin)
+            header, digests = read_header(rdr)
+            print(f'FILE #{fileno:d}          :', fpn)
+            print('Generated on     :', header[1][1])
+            print('Source directory :', header[2][1][:50])
+            rdrs.append(rdr)
+            digestlists.append(digests)
+        print('')
+
+        digests = [name for name in digestlists[0]
+                   if all(name in dl for dl in digestlists)]
+        if not digests:
+            raise Exception('The files do not have any digest in common')
+        digestixs = [[5+dl.index(name) for name in digests]
+                     for dl in digestlists]
+        print('Comparing digests:', ', '.join(digests))
+        print('')
+
+        stats = dict.fromkeys(['entries', 'agree', 'incomplete', 'errors'], 0)
+        stats['held'] = [0]*N
+        stats['missing'] = [0]*N
+        stats['odd'] = [0]*N
+        stats['pairs'] = [[0]*N for i in range(N)]
+        # (key, fileix, line) from all files, merged in sorted order
+        def tagged(rdr, fileix):
+            for key, ln in iter_sorted(iter_rawlines(rdr), fileix+1):
+                yield key, fileix, ln
+        merged = heapq.merge(*[tagged(rdr, fileix)
+                               for fileix, rdr in enumerate(rdrs)])
+        for key, group in tqdm(groupby(merged, key=lambda item: item[0]),
+                               unit='entry'):
+            stats['entries'] += 1
+            found = {fileix: tuple(ln[ix] for ix in digestixs[fileix])
+                     for _, fileix, ln in group}
+            for fileix in found:
+                stats['held'][fileix] += 1
+                for fileix2 in found:
+                    if found[fileix2] == found[fileix]:
+                        stats['pairs'][fileix][fileix2] += 1
+            status = ['missing']*N
+            odd = []
+            counted = Counter(found.values()).most_common(2)
+            if len(counted) == 1:
+                for fileix in found:
+                    status[fileix] = 'ok'
+            else:
+                stats['errors'] += 1
+                majority = None
+                if counted[0][1] > counted[1][1]:
+                    majority = counted[0][0]
+                for fileix, fdigests in found.items():
+                    if fdigests == majority:
+                        status[fileix] = 'ok'
+                    else:
+                        status[fileix] = 'differs'
+                        if majority is not None:
+                            odd.append(fileix+1)
+                            stats['odd'][fileix] += 1
+                tqdm.write('Checksum error (file {0:s}): "{1:s}"'.\
+                           format(','.join(str(fileno) for fileno in odd)
+                                  or '?', '/'.join(key)))
+            if len(found) < N:
+                stats['incomplete'] += 1
+                for fileix in range(N):
+                    if fileix not in found:
+                        stats['missing'][fileix] += 1
+            elif len(counted) == 1:
+                stats['agree'] += 1
+                continue
+            if wrtreport is not None:
+                wrtreport.writerow([key[0] or '.', key[1]] + status +
+                                   [','.join(str(fileno) for fileno in odd)])
+    return stats
+
+
 #%% main program
 
-cli = argparse.ArgumentParser()
-cli.add_argument("file1", type=str,
-                 help="first superhash file")
-cli.add_argument("file2", type=str,
-                 help="2nd superhash file")
-cli.add_argument("-m", "--missing", type=str,
-                 help="file to write the list of missing entries to")
-clargs = cli.parse_args()
-
-
-
-print('')
-print("MANBAMM's superhash-check - v"+__version__+" - by M.H.V. Werts, 2022-2025")
-print("")
-
-print('FILE #1')
-print('=======')
-sh1 = SuperhashIndex(clargs.file1)
-sh1.print_stats()
-
-print('FILE #2')
-print('=======')
-sh2 = SuperhashIndex(clargs.file2)
-sh2.print_stats()
-
-# search the lines present in sh2 in sh1, and compare MD5 checksums
-
-print('Check data lines in File #2 against File #1')
-print('===========================================')
-
-if clargs.missing is None:
-    dump_missing = False
-else:
-    dump_missing = True
-    fmiss = open(clargs.missing, 'w', encoding='utf-8')
-    wrtmiss = csv.writer(fmiss, delimiter='\t', lineterminator='\n',
-                         quoting=csv.QUOTE_NONE)
-
-lmissing = []
-Nerrorsum = 0
-for ln in tqdm(sh2.lines):
-    rix = sh1.seqsearch(ln[1], ln[2])
-    if rix is not None:
-        if not ln[5] == sh1.lines[rix][5]:
-            tqdm.write('MD5 checksum error: line {0:10d} "{1:s}"'.\
-                       format(rix, ln[2]))
-            Nerrorsum += 1
+# The main program is only run when this file is executed as a script, not
+# when it is imported by the worker processes for reading (--jobs).
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("file1", type=str,
+                     help="first superhash file (the index, with"
+                          " --verify-tree)")
+    cli.add_argument("file2", type=str, nargs='?',
+                     help="2nd superhash file")
+    cli.add_argument("more", type=str, nargs='*',
+                     help="further superhash files (implies --nway)")
+    cli.add_argument("-m", "--missing", type=str,
+                     help="file to write the list of missing entries to")
+    cli.add_argument("-s", "--stream", action='store_true',
+                     help="compare sorted files in a single pass, with constant"
+                          " memory use")
+    cli.add_argument("-t", "--tree", action='store_true',
+                     help="compare the directory trees top-down, skipping"
+                          " subtrees with identical directory digests (files"
+                          " generated with superhash v0.6 and later)")
+    cli.add_argument("--moves", type=str,
+                     help="classify the entries of File #2 not found in File #1"
+                          " as moved, renamed, duplicated or new, and write"
+                          " them to this file")
+    cli.add_argument("-j", "--jobs", type=int, default=1,
+                     help="number of processes for reading superhash files"
+                          " (default: 1)")
+    cli.add_argument("--verify-tree", type=str, metavar='DIR',
+                     help="verify the files in directory tree DIR against"
+                          " the index file1, hashing --jobs files"
+                          " concurrently")
+    cli.add_argument("-x", "--failfast", action='store_true',
+                     help="with --verify-tree, stop at the first failure")
+    cli.add_argument("-q", "--quick", action='store_true',
+                     help="with --verify-tree, check quick fingerprints first,"
+                          " and calculate full digests only if they differ or"
+                          " are missing")
+    cli.add_argument("-N", "--nway", action='store_true',
+                     help="compare all files with each other in a single pass,"
+                          " with constant memory use")
+    cli.add_argument("--report", type=str,
+                     help="with --nway, file to write the entries on which the"
+                          " files do not agree to")
+    clargs = cli.parse_args()
+    if clargs.more:
+        clargs.nway = True
+
+
+
+    print('')
+    print("MANBAMM's superhash-check - v"+__version__+" - by M.H.V. Werts, 2022-2025")
+    print("")
+
+    if clargs.jobs < 1:
+        print('Error: --jobs should be at least 1')
+        exit(2)
+    if (clargs.stream + clargs.tree + clargs.nway) > 1:
+        print('Error: only one of --stream, --tree and --nway can be used')
+        exit(2)
+    if (clargs.stream or clargs.tree) and (clargs.moves is not None):
+        print('Error: --moves cannot be used with --stream or --tree')
+        exit(2)
+    if clargs.nway and ((clargs.missing is not None) or
+                        (clargs.moves is not None)):
+        print('Error: --missing and --moves cannot be used with --nway,'
+              ' use --report')
+        exit(2)
+    if (clargs.report is not None) and not clargs.nway:
+        print('Error: --report can only be used with --nway')
+        exit(2)
+    if clargs.verify_tree is not None:
+        if (clargs.file2 is not None) or clargs.stream or clargs.tree or \
+           (clargs.missing is not None) or (clargs.moves is not None):
+            print('Error: --verify-tree takes a single superhash file, and'
+                  ' cannot be used with other modes')
+            exit(2)
+        if not os.path.isdir(clargs.verify_tree):
+            print('Error: --verify-tree: not a directory')
+            exit(2)
+    elif clargs.file2 is None:
+        print('Error: Please supply a 2nd superhash file')
+        exit(2)
+    if (clargs.failfast or clargs.quick) and (clargs.verify_tree is None):
+        print('Error: --failfast and --quick can only be used with'
+              ' --verify-tree')
+        exit(2)
+
+    if clargs.missing is None:
+        dump_missing = False
+        wrtmiss = None
     else:
-        lmissing.append([ln[0].isoformat(),
-                         ln[1].as_posix(),
-                         ln[2],
-                         ln[3].isoformat(),
-                         ln[4],
-                         ln[5]])
-Nnotfound = len(lmissing)
-if dump_missing:
-    wrtmiss.writerows(lmissing)
-    fmiss.close()
-
-print('')
-print()
-print('RESULT')
-print('======')
-
-if (Nnotfound > 0):
-    print('Not found : {0:d} files (entries present in File#2 but not in File#1)'.\
-          format(Nnotfound))
-    if not dump_missing:
-        print('            (If you want to generate a file with a list of the')
-        print('            missing files, use the -m option).')
-else:
-    print('All entries in File#2 are present in File#1. Good!')
-    
-if (Nerrorsum > 0):    
-    print('ERRORS    : {0:d} files (MD5 checksums disagree)'.format(Nerrorsum))
-else:
-    print('All MD5 checksums are good! No errors detected.')
-
-print('')
-print('')
+        dump_missing = True
+        fmiss = open(clargs.missing, 'w', encoding='utf-8')
+        wrtmiss = csv.writer(fmiss, delimiter='\t', lineterminator='\n',
+                             quoting=csv.QUOTE_NONE)
+
+    if clargs.verify_tree is not None:
+        print('INDEX')
+        print('=====')
+        sh = SuperhashIndex(clargs.file1, clargs.jobs)
+        sh.print_stats()
+        print('Verify directory tree against index')
+        print('===================================')
+        print('Directory        :', clargs.verify_tree)
+        print('')
+        counts = verify_tree(clargs.verify_tree, sh, clargs.jobs,
+                             clargs.failfast, clargs.quick)
+    elif clargs.nway:
+        fpns = [clargs.file1, clargs.file2] + clargs.more
+        if not common_digests(fpns):
+            no_common_digest()
+        print('Compare {0:d} files line by line'.format(len(fpns)))
+        print('============================')
+        if clargs.report is None:
+            stats = nway_compare(fpns)
+        else:
+            with open(clargs.report, 'w', encoding='utf-8') as freport:
+                wrtreport = csv.writer(freport, delimiter='\t',
+                                       lineterminator='\n',
+                                       quoting=csv.QUOTE_NONE)
+                stats = nway_compare(fpns, wrtreport)
+    elif clargs.stream or clargs.tree:
+        if not common_digests([clargs.file2, clargs.file1]):
+            no_common_digest()
+        if clargs.tree:
+            try:
+                dirdigests = [read_directory_digests(fpn)
+                              for fpn in (clargs.file1, clargs.file2)]
+            except ValueError as err:
+                print('Warning: {0:s}'.format(str(err)))
+                print('         Comparing line by line instead (--stream)')
+                print('')
+                clargs.tree = False
+                clargs.stream = True
+        if clargs.tree:
+            print('Compare File #2 and File #1 by directory')
+            print('========================================')
+            counts = tree_compare(clargs.file1, clargs.file2, wrtmiss,
+                                  dirdigests)
+        else:
+            print('Compare File #2 and File #1 line by line')
+            print('========================================')
+            counts = stream_compare(clargs.file1, clargs.file2, wrtmiss)
+        Nnotfound = counts['notfound']
+        Nerrorsum = counts['errors']
+        if dump_missing:
+            fmiss.close()
+    else:
+        print('FILE #1')
+        print('=======')
+        sh1 = SuperhashIndex(clargs.file1, clargs.jobs)
+        sh1.print_stats()
+
+        print('FILE #2')
+        print('=======')
+        sh2 = SuperhashIndex(clargs.file2, clargs.jobs)
+        sh2.print_stats()
+
+        # search the lines present in sh2 in sh1, and compare the digests that
+        # are present in both files
+
+        digests = [name for name in sh2.digests if name in sh1.digests]
+        if not digests:
+            no_common_digest()
+        digestk1 = [sh1.digests.index(name) for name in digests]
+        digestk2 = [sh2.digests.index(name) for name in digests]
+        print('Comparing digests:', ', '.join(digests))
+        print('')
+
+        print('Check data lines in File #2 against File #1')
+        print('===========================================')
+
+        lmissing = []
+        matched = bytearray(sh1.Nlines)
+        Nerrorsum = 0
+        for ix in tqdm(range(sh2.Nlines)):
+            rix = sh1.search(sh2.dir(ix), sh2.fnames[ix])
+            if rix is not None:
+                matched[rix] = 1
+                baddigests = [name for name, k1, k2
+                              in zip(digests, digestk1, digestk2)
+                              if not sh2.rawdigest(k2, ix) == sh1.rawdigest(k1, rix)]
+                if baddigests:
+                    tqdm.write('Checksum error ({0:s}): line {1:10d} "{2:s}"'.\
+                               format(','.join(baddigests), rix, sh2.fnames[ix]))
+                    Nerrorsum += 1
+            else:
+                lmissing.append(ix)
+        Nnotfound = len(lmissing)
+        if dump_missing:
+            for ix in lmissing:
+                ln = sh2.line(ix)
+                wrtmiss.writerow([ln[0].isoformat(),
+                                  ln[1].as_posix(),
+                                  ln[2],
+                                  ln[3].isoformat(),
+                                  ln[4]] + ln[5:])
+            fmiss.close()
+
+        if clargs.moves is not None:
+            # identify the entries not found by their contents (size and digest)
+            cname = 'md5' if ('md5' in digests) else digests[0]
+            classified = classify_missing(sh1, sh2,
+                                          sh1.digests.index(cname),
+                                          sh2.digests.index(cname),
+                                          lmissing, matched)
+            movecounts = dict.fromkeys(['moved', 'renamed', 'duplicated', 'new'],
+                                       0)
+            with open(clargs.moves, 'w', encoding='utf-8') as fmoves:
+                wrtmoves = csv.writer(fmoves, delimiter='\t', lineterminator='\n',
+                                      quoting=csv.QUOTE_NONE)
+                for status, ix1, ix2 in classified:
+                    movecounts[status] += 1
+                    if ix1 is None:
+                        source = ['', '']
+                    else:
+                        source = [sh1.dir(ix1) or '.', sh1.fnames[ix1]]
+                    ln = sh2.line(ix2)
+                    wrtmoves.writerow([status] + source +
+                                      [ln[0].isoformat(),
+                                       ln[1].as_posix(),
+                                       ln[2],
+                                       ln[3].isoformat(),
+                                       ln[4]] + ln[5:])
+
+    print('')
+    print()
+    print('RESULT')
+    print('======')
+
+    if clargs.verify_tree is not None:
+        if counts['stopped']:
+            print('STOPPED   : at the first failure (--failfast)')
+        print('Verified  : {0:d} files (identical size and checksums)'.\
+              format(counts['verified']))
+        if clargs.quick:
+            print('  (quick fingerprint {0:d}, full digests {1:d}, of which'
+                  ' {2:d} after a fingerprint mismatch or none)'.format(
+                  counts['quick'], counts['verified']-counts['quick'],
+                  counts['escalated']))
+        if (counts['nodigest'] > 0):
+            print('Size only : {0:d} files (no checksum in index)'.\
+                  format(counts['nodigest']))
+        Nfailures = sum(counts[key] for key in ['notfound', 'missing',
+                                                'sizeerrors', 'errors',
+                                                'unreadable'])
+        if (Nfailures > 0):
+            print('Not found : {0:d} files (present in the tree but not in'
+                  ' the index)'.format(counts['notfound']))
+            print('Missing   : {0:d} files (present in the index but not in'
+                  ' the tree)'.format(counts['missing']))
+            print('ERRORS    : {0:d} files differ in size, {1:d} files in'
+                  ' checksum'.format(counts['sizeerrors'], counts['errors']))
+            print('Unreadable: {0:d} files (could not be read)'.\
+                  format(counts['unreadable']))
+        else:
+            print('All files are present and good! No errors detected.')
+        print('Mtime     : {0:d} files differ in mtime (identical checksums)'.\
+              format(counts['mtimedrift']))
+    elif clargs.nway:
+        N = len(fpns)
+        print('Entries   : {0:d} entries in total'.format(stats['entries']))
+        print('Agree     : {0:d} entries (present in all files, identical'
+              ' checksums)'.format(stats['agree']))
+        print('Missing   : {0:d} entries (missing in one or more files)'.\
+              format(stats['incomplete']))
+        if (stats['errors'] > 0):
+            print('ERRORS    : {0:d} entries (checksums disagree)'.\
+                  format(stats['errors']))
+        else:
+            print('All checksums are good! No errors detected.')
+        print('')
+        print('File    Entries    Missing    Odd one out')
+        for fileix in range(N):
+            print('#{0:<4d} {1:9d}  {2:9d}  {3:9d}'.format(fileix+1,
+                  stats['held'][fileix], stats['missing'][fileix],
+                  stats['odd'][fileix]))
+        print('')
+        print('Agreement matrix (entries present in both files, with identical'
+              ' checksums)')
+        print('     '+''.join('{0:>11s}'.format('#'+str(fileix+1))
+                              for fileix in range(N)))
+        for fileix in range(N):
+            print('#{0:<4d}'.format(fileix+1)+
+                  ''.join('{0:11d}'.format(Npair)
+                          for Npair in stats['pairs'][fileix]))
+    else:
+        if (Nnotfound > 0):
+            print('Not found : {0:d} files (entries present in File#2 but not in File#1)'.\
+                  format(Nnotfound))
+            if not dump_missing:
+                print('            (If you want to generate a file with a list of the')
+                print('            missing files, use the -m option).')
+        else:
+            print('All entries in File#2 are present in File#1. Good!')
+
+        if (Nerrorsum > 0):    
+            print('ERRORS    : {0:d} files (checksums disagree)'.format(Nerrorsum))
+        else:
+            print('All checksums are good! No errors detected.')
+
+        if clargs.stream or clargs.tree:
+            print('Missing   : {0:d} files (entries present in File#1 but not in File#2)'.\
+                  format(counts['notinfile2']))
+            print('Size      : {0:d} files differ in size (identical checksums)'.\
+                  format(counts['sizedrift']))
+            print('Mtime     : {0:d} files differ in mtime (identical checksums)'.\
+                  format(counts['mtimedrift']))
+        if clargs.tree:
+            print('Skipped   : {0:d} files in identical subtrees ({1:d} directories'
+                  ' compared)'.format(counts['skipped'], counts['dirs']))
+        elif clargs.moves is not None:
+            print('Not found, classified by content ({0:s}):'.format(cname))
+            for status, N in movecounts.items():
+                print('  {0:10s}: {1:d} files'.format(status, N))
+
+    print('')
+    print('')
+    if (clargs.verify_tree is not None) and (Nfailures > 0):
+        exit(1)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# superhash-dupes.py finds files with identical content in one or more
+# superhash files, using only the sizes and checksums recorded in these
+# files (the files themselves are not accessed).
+#
+# The superhash files are read twice. The first pass counts the file sizes,
+# in a fixed-size table of saturating counters. In the second pass, only
+# entries whose size may occur more than once are kept as candidates. These
+# are sorted by (size, digest), spilling sorted runs to temporary files if
+# there are more than fit in memory, and grouped into clusters of identical
+# files. Memory use thus does not depend on the size of the superhash files.
+#
+
+__version__ = '0.6'
+
+import argparse
+import heapq
+import pickle
+import tempfile
+from array import array
+from itertools import groupby
+import csv
+
+from tqdm import tqdm
+
+from superhash_format import open_superhash, tsv_reader, read_header, \
+                             iter_tsv_lines
+
+#%% classes and functions
+
+SIZEBUCKETS = 1 << 26 # counters in the size table (1 byte each)
+MAXROWS = 1000000 # rows sorted in memory, before spilling to a temporary file
+
+
+def iter_entries(fpn, digest):
+    """
+    Iterate over the entries of a superhash file.
+
+    Parameters
+    ----------
+    fpn : str
+        Superhash file.
+    digest : str
+        Name of the digest (e.g. 'md5').
+
+    Yields
+    ------
+    size : int
+    hexdigest : str
+    rel_path_posix : str
+    filename : str
+
+    Entries without a digest (files that disappeared while hashing, or
+    files indexed with --nohash) are skipped.
+    """
+    with open_superhash(fpn) as fin:
+        _, digests = read_header(tsv_reader(fin))
+        if not (digest in digests):
+            raise Exception(f'No {digest} digests in "{fpn}"')
+        digestix = 5 + digests.index(digest)
+        for rawln in iter_tsv_lines(fin):
+            if len(rawln) <= digestix:
+                break
+            hexdigest = rawln[digestix]
+            if (not hexdigest) or hexdigest.startswith('!'):
+                continue
+            yield int(rawln[4]), hexdigest, rawln[1], rawln[2]
+
+
+def size_bucket(size):
+    """Counter in the size table for a file size"""
+    return ((size * 0x9E3779B97F4A7C15) >> 17) % SIZEBUCKETS
+
+
+def count_sizes(fpns, digest, minsize):
+    """
+    First pass: count the file sizes in a table of SIZEBUCKETS saturating
+    counters (0, 1 or 2 and more). Sizes that share a counter with other
+    sizes may be counted as duplicate; this only affects the number of
+    candidates in the second pass, not the result.
+
+    Returns
+    -------
+    counts : array
+        Size table.
+    Nentries : int
+        Total number of entries.
+    """
+    counts = array('B', bytes(SIZEBUCKETS))
+    Nentries = 0
+    for fpn in fpns:
+        for size, _, _, _ in tqdm(iter_entries(fpn, digest), unit='entry',
+                                  desc='sizes'):
+            Nentries += 1
+            if size < minsize:
+                continue
+            ix = size_bucket(size)
+            if counts[ix] < 2:
+                counts[ix] += 1
+    return counts, Nentries
+
+
+def write_run(items):
+    """Write sorted items to a temporary file, returning the file"""
+    frun = tempfile.TemporaryFile()
+    for item in items:
+        pickle.dump(item, frun, pickle.HIGHEST_PROTOCOL)
+    frun.seek(0)
+    return frun
+
+
+def read_run(frun):
+    """Iterate over the items of a temporary file written by write_run()"""
+    while True:
+        try:
+            yield pickle.load(frun)
+        except EOFError:
+            frun.close()
+            return
+
+
+def external_sort(items, key=None, maxrows=MAXROWS):
+    """
+    Sort items (picklable), holding at most maxrows items in memory. Sorted
+    runs of maxrows items are written to temporary files, which are merged.
+
+    Yields
+    ------
+    Items, in sorted order.
+    """
+    runs = []
+    buf = []
+    for item in items:
+        buf.append(item)
+        if len(buf) >= maxrows:
+            buf.sort(key=key)
+            runs.append(write_run(buf))
+            buf = []
+    buf.sort(key=key)
+    if not runs:
+        yield from buf
+        return
+    if buf:
+        runs.append(write_run(buf))
+    del buf
+    yield from heapq.merge(*[read_run(frun) for frun in runs], key=key)
+
+
+def find_clusters(fpns, digest='md5', minsize=1, maxrows=MAXROWS):
+    """
+    Find clusters of files with identical size and digest in superhash
+    files.
+
+    Parameters
+    ----------
+    fpns : list of str
+        Superhash files.
+    digest : str, optional
+        Name of the digest. The default is 'md5'.
+    minsize : int, optional
+        Smaller files are ignored. The default is 1 (ignore empty files).
+    maxrows : int, optional
+        Maximum number of rows held in memory for sorting.
+
+    Returns
+    -------
+    clusters : iterator
+        Clusters as tuples (reclaimable, size, hexdigest, members), in
+        order of decreasing reclaimable space (size times the number of
+        copies in excess of one). members is a list of (fileno, dir,
+        filename) tuples, with fileno the number of the superhash file.
+    stats : dict
+        Numbers of entries, candidates after size pruning, clusters,
+        duplicate files and reclaimable bytes. Complete once clusters
+        has been consumed.
+    """
+    counts, Nentries = count_sizes(fpns, digest, minsize)
+    stats = {'entries': Nentries, 'candidates': 0, 'clusters': 0,
+             'duplicates': 0, 'reclaimable': 0}
+
+    def candidates():
+        for fileno, fpn in enumerate(fpns, start=1):
+            for size, hexdigest, dirn, fname in tqdm(
+                    iter_entries(fpn, digest), unit='entry',
+                    desc='candidates'):
+                if (size >= minsize) and (counts[size_bucket(size)] > 1):
+                    stats['candidates'] += 1
+                    yield (size, hexdigest, fileno, dirn, fname)
+
+    def clusters():
+        for (size, hexdigest), group in groupby(
+                external_sort(candidates(), maxrows=maxrows),
+                key=lambda row: row[:2]):
+            members = [row[2:] for row in group]
+            if len(members) > 1:
+                reclaimable = size * (len(members) - 1)
+                stats['clusters'] += 1
+                stats['duplicates'] += len(members) - 1
+                stats['reclaimable'] += reclaimable
+                yield (-reclaimable, size, hexdigest, members)
+
+    def ordered():
+        for negreclaim, size, hexdigest, members in \
+                external_sort(clusters(), maxrows=maxrows):
+            yield (-negreclaim, size, hexdigest, members)
+
+    return ordered(), stats
+
+
+#%% main program
+
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("files", type=str, nargs='+',
+                     help="superhash files")
+    cli.add_argument("-o", "--outpath", type=str,
+                     help="file to write all clusters of duplicate files to")
+    cli.add_argument("-n", "--top", type=int, default=20,
+                     help="number of clusters to print (default: 20)")
+    cli.add_argument("-d", "--digest", type=str, default='md5',
+                     help="digest used to identify identical files"
+                          " (default: md5)")
+    cli.add_argument("--min-size", type=int, default=1,
+                     help="ignore files smaller than this (bytes, default: 1)")
+    cli.add_argument("--max-rows", type=int, default=MAXROWS,
+                     help="rows sorted in memory before spilling to a"
+                          " temporary file (default: {0:d})".format(MAXROWS))
+    clargs = cli.parse_args()
+
+    print('')
+    print("MANBAMM's superhash-dupes - v"+__version__+\
+          " - by M.H.V. Werts, 2022-2026")
+    print("")
+
+    if clargs.digest == 'quick':
+        print('Error: quick fingerprints cannot be used to identify'
+              ' identical files')
+        exit(2)
+    if clargs.max_rows < 1:
+        print('Error: --max-rows should be at least 1')
+        exit(2)
+    for fileno, fpn in enumerate(clargs.files, start=1):
+        print('File #{0:d}                     : {1:s}'.format(fileno, fpn))
+    print('')
+
+    if clargs.outpath is None:
+        fout = None
+    else:
+        fout = open(clargs.outpath, 'w', encoding='utf-8')
+        wrtout = csv.writer(fout, delimiter='\t', lineterminator='\n',
+                            quoting=csv.QUOTE_NONE)
+        wrtout.writerow(['# cluster', 'reclaimable', 'size',
+                         clargs.digest+'digest', 'file', 'rel_path_posix',
+                         'filename'])
+
+    try:
+        clusters, stats = find_clusters(clargs.files, clargs.digest,
+                                        clargs.min_size, clargs.max_rows)
+        top = []
+        for clusterno, (reclaimable, size, hexdigest, members) in \
+                enumerate(clusters, start=1):
+            if clusterno <= clargs.top:
+                top.append((reclaimable, size, hexdigest, members))
+            if fout is not None:
+                for fileno, dirn, fname in members:
+                    wrtout.writerow([clusterno, reclaimable, size, hexdigest,
+                                     fileno, dirn, fname])
+    except Exception as e:
+        print('Error:', e)
+        exit(2)
+    if fout is not None:
+        fout.close()
+
+    print('')
+    print('Largest clusters')
+    print('================')
+    for reclaimable, size, hexdigest, members in top:
+        print('{0:d} bytes reclaimable: {1:d} copies of {2:d} bytes ({3:s})'\
+              .format(reclaimable, len(members), size, hexdigest))
+        for fileno, dirn, fname in members:
+            print('    #{0:d}  {1:s}/{2:s}'.format(fileno, dirn, fname))
+    print('')
+    print('Summary')
+    print('=======')
+    print('Number of entries           :', stats['entries'])
+    print('Candidates (size not unique):', stats['candidates'])
+    print('Clusters of identical files :', stats['clusters'])
+    print('Duplicate files             :', stats['duplicates'])
+    print('Reclaimable bytes           :', stats['reclaimable'])
+    print('')
@@ -5,9 +5,16 @@
 #         to explicitly specify 'utf-8' as the encoding of files, else
 #         Python will use the platform-specific encoding
 
-__version__ = '0.2'  
+__version__ = '0.6'  
 
 CHUNKSIZE = 67108864 # 64 MiB size, for hashing in chunks
+SMALLFILE_SIZE = 1048576 # files under 1 MiB: hashed from a single os.read()
+PARALLEL_DIGEST_MINSIZE = 1048576 # chunks from 1 MiB: digests in parallel
+CHECKPOINT_INTERVAL = 30 # seconds between checkpoints in the result file
+CHECKPOINT_SEARCHSIZE = 1048576 # 1 MiB blocks for finding last checkpoint
+DECOMPRESS_BLOCKSIZE = 1048576 # 1 MiB blocks for finding compressed members
+DIRECT_ALIGN = 4096 # alignment of buffers and read sizes for direct I/O
+DEVICE_QUEUE = 16 # tasks queued per hashing thread (--jobs, --device-jobs)
 
 import sys
 import os
@@ -15,12 +22,930 @@ import os.path
 import argparse
 from pathlib import Path
 import hashlib
+import heapq
+import gzip
+import lzma
+import zlib
+import errno
+import mmap
+import time
+import threading
 from datetime import datetime
 import csv
 import json
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
+from superhash_format import compressor, is_compressed, open_superhash, \
+                             read_superhash_columns, iter_superhash_rows, \
+                             quick_digest
+
+
+#%% classes and functions
+
+class CompressedTextWriter:
+    """
+    Text writer for a compressed (.gz or .xz) superhash file.
+
+    The file is written as a series of compressed members (gzip) or streams
+    (xz), which are decompressed as a whole by gzip and lzma. A member is
+    completed, and made sure to be on disk, with sync(). The file can then
+    be read up to that point, also if superhash is interrupted later. The
+    file can be appended to (--resume) by adding members.
+
+    tell() gives the position in the uncompressed data, starting from
+    offset (the size of the uncompressed data already in the file, when
+    appending).
+    """
+    def __init__(self, fpn, mode='w', offset=0):
+        self.module = compressor(fpn)
+        self.fraw = open(fpn, mode+'b')
+        self.fcomp = None
+        self.offset = offset
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        if self.fcomp is None:
+            # start a new member
+            if self.module is gzip:
+                self.fcomp = gzip.GzipFile(fileobj=self.fraw, mode='wb',
+                                           compresslevel=6, mtime=0)
+            else:
+                self.fcomp = lzma.LZMAFile(self.fraw, 'wb')
+        self.fcomp.write(data)
+        self.offset += len(data)
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        # compressed data can only be flushed by completing the member
+        pass
+
+    def sync(self):
+        """Complete the current member, and make sure that it is on disk"""
+        if self.fcomp is not None:
+            self.fcomp.close()
+            self.fcomp = None
+        self.fraw.flush()
+        os.fsync(self.fraw.fileno())
+
+    def close(self):
+        if self.fcomp is not None:
+            self.fcomp.close()
+            self.fcomp = None
+        self.fraw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_result(fpn, mode='w', offset=0):
+    """
+    Open the result file for writing (mode 'w') or appending (mode 'a').
+    For compressed files (.gz, .xz), offset is the size of the uncompressed
+    data in the file, when appending.
+    """
+    if is_compressed(fpn):
+        return CompressedTextWriter(fpn, mode, offset)
+    return open(fpn, mode, encoding='utf-8', newline='\n')
+
+
+_digest_pool = None
+_digest_pool_lock = threading.Lock()
+
+def update_hashers(hashers, chunk):
+    """
+    Feed a chunk of data to all hashers. For large chunks and several
+    hashers, the hashers are updated in parallel threads (hashlib releases
+    the GIL), so that a single read of the data serves all digests at the
+    speed of the slowest one.
+    """
+    global _digest_pool
+    if (len(hashers) > 1) and (len(chunk) >= PARALLEL_DIGEST_MINSIZE):
+        with _digest_pool_lock:
+            if _digest_pool is None:
+                _digest_pool = ThreadPoolExecutor()
+        for fut in [_digest_pool.submit(h.update, chunk) for h in hashers]:
+            fut.result()
+    else:
+        for h in hashers:
+            h.update(chunk)
+
+
+class IOPolicy:
+    """
+    How files are read for hashing (--io-policy, --max-rate, --max-files).
+
+    With policy 'nocache', the OS is advised that files are read
+    sequentially, and that the data that has been hashed is not needed
+    anymore (posix_fadvise, or F_NOCACHE on MacOS), so that hashing a large
+    tree does not evict the data of other programs from the page cache.
+    With policy 'direct', files of SMALLFILE_SIZE and larger are read with
+    direct I/O (O_DIRECT), bypassing the page cache altogether; smaller
+    files, and files on file systems that do not support direct I/O, are
+    read as with 'nocache'.
+
+    The read rate (bytes per second) and the number of files opened per
+    second can be limited. The limits apply to all hashing threads
+    together.
+    """
+    def __init__(self, policy='default', max_rate=None, max_files=None):
+        self.policy = policy
+        self.nocache = policy in ('nocache', 'direct')
+        self.direct = (policy == 'direct')
+        self.byte_interval = 1.0/max_rate if max_rate else 0.0
+        self.file_interval = 1.0/max_files if max_files else 0.0
+        self.lock = threading.Lock()
+        self.tbytes = self.tfiles = time.monotonic()
+
+    @staticmethod
+    def supported(policy):
+        """Check whether the policy is supported on this platform"""
+        if policy == 'direct':
+            return hasattr(os, 'O_DIRECT') and hasattr(os, 'posix_fadvise')
+        if policy == 'nocache':
+            return hasattr(os, 'posix_fadvise') or \
+                   (sys.platform == 'darwin')
+        return True
+
+    def _wait(self, attr, interval):
+        """
+        Advance the time (attribute attr) at which the next read is allowed
+        by interval, and wait until the current one is allowed. Time not
+        used while idle is not saved up for later bursts.
+        """
+        with self.lock:
+            now = time.monotonic()
+            tnext = max(getattr(self, attr), now) + interval
+            setattr(self, attr, tnext)
+        if tnext - interval > now:
+            time.sleep(tnext - interval - now)
+
+    def open(self, filepath, fpsize):
+        """
+        Open a file for hashing. Returns the file descriptor, and whether
+        the file was opened for direct I/O.
+        """
+        if self.file_interval:
+            self._wait('tfiles', self.file_interval)
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+        if self.direct and (fpsize >= SMALLFILE_SIZE):
+            try:
+                return os.open(filepath, flags | os.O_DIRECT), True
+            except OSError as err:
+                # file system without support for direct I/O
+                if err.errno != errno.EINVAL:
+                    raise
+        fd = os.open(filepath, flags)
+        if self.nocache:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            else:
+                import fcntl
+                fcntl.fcntl(fd, fcntl.F_NOCACHE, 1)
+        return fd, False
+
+    def done(self, fd, offset, nbytes):
+        """
+        To be called after reading nbytes at offset: drops the data from the
+        page cache (policy 'nocache') and waits as needed to stay within
+        the maximum read rate.
+        """
+        if self.nocache and hasattr(os, 'posix_fadvise') and nbytes:
+            os.posix_fadvise(fd, offset, nbytes, os.POSIX_FADV_DONTNEED)
+        if self.byte_interval:
+            self._wait('tbytes', nbytes*self.byte_interval)
+
+
+io_policy = IOPolicy()
+
+_read_buffers = threading.local()
+
+def read_buffer(direct=False):
+    """
+    Read buffer of CHUNKSIZE bytes for the current thread, allocated only
+    once. For direct I/O, the buffer is page-aligned (anonymous mmap).
+    """
+    if direct:
+        buf = getattr(_read_buffers, 'dbuf', None)
+        if buf is None:
+            buf = _read_buffers.dbuf = memoryview(mmap.mmap(-1, CHUNKSIZE))
+    else:
+        buf = getattr(_read_buffers, 'buf', None)
+        if buf is None:
+            buf = _read_buffers.buf = memoryview(bytearray(CHUNKSIZE))
+    return buf
+
+
+def quick_fingerprint(filepath, fpsize):
+    """
+    Calculate the 'quick' fingerprint of a file (see
+    superhash_format.quick_digest()), reading it according to io_policy.
+    Returns the hexadecimal digest.
+    """
+    fd, _ = io_policy.open(filepath, 0)
+    with open(fd, 'rb') as fin:
+        hasher = quick_digest(fin, fpsize,
+                              lambda offset, nbytes:
+                                  io_policy.done(fd, offset, nbytes))
+    return hasher.hexdigest()
+
+
+def hash_file(filepath, fpsize, digests=('md5',)):
+    """
+    Calculate the digests of a file, without allocating new buffers for the
+    file data.
+
+    Small files (under SMALLFILE_SIZE) are read with a single os.read().
+    Larger files are read with readinto() into a buffer of CHUNKSIZE bytes,
+    which is allocated only once for each thread. Files smaller than
+    CHUNKSIZE are read in one go (the chunk size is taken from the file
+    size). Files are opened and read according to io_policy.
+
+    Parameters
+    ----------
+    filepath : str
+        Full path to the file.
+    fpsize : int
+        Size of the file, as obtained from stat(). The digests are calculated
+        over the actual contents of the file, also if the size has changed.
+    digests : sequence of str, optional
+        Names (hashlib) of the digests, or 'quick' for the quick fingerprint.
+        The default is ('md5',).
+
+    Returns
+    -------
+    list of str
+        Hexadecimal digests.
+
+    """
+    if 'quick' in digests:
+        fulldigests = [name for name in digests if name != 'quick']
+        hexdigests = hash_file(filepath, fpsize, fulldigests) \
+                     if fulldigests else []
+        hexdigests.insert(list(digests).index('quick'),
+                          quick_fingerprint(filepath, fpsize))
+        return hexdigests
+    hashers = [hashlib.new(name) for name in digests]
+    fd, direct = io_policy.open(filepath, fpsize)
+    try:
+        offset = 0
+        if fpsize < SMALLFILE_SIZE:
+            data = os.read(fd, fpsize + 1)
+            update_hashers(hashers, data)
+            io_policy.done(fd, 0, len(data))
+            if len(data) <= fpsize:
+                # a short read on a regular file means end-of-file
+                return [h.hexdigest() for h in hashers]
+            offset = len(data)
+        if direct:
+            # read sizes must be multiples of DIRECT_ALIGN
+            bufsize = -(-(fpsize + 1) // DIRECT_ALIGN) * DIRECT_ALIGN
+        else:
+            bufsize = fpsize + 1
+        buf = read_buffer(direct)[:min(CHUNKSIZE, bufsize)]
+        with open(fd, 'rb', buffering=0, closefd=False) as _file:
+            while True:
+                nread = _file.readinto(buf)
+                if not nread:
+                    break
+                update_hashers(hashers, buf[:nread])
+                io_policy.done(fd, offset, nread)
+                offset += nread
+                if direct and (nread < len(buf)):
+                    # end-of-file (reading on from an unaligned offset
+                    # is not allowed with direct I/O)
+                    break
+    finally:
+        os.close(fd)
+    return [h.hexdigest() for h in hashers]
+
+
+def scan_file(filepath, rootrel_posix, file, fpstat, digests=('md5',),
+              nohash=False):
+    """
+    Collect the superhash information for a single file.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path
+        Full path to the file.
+    rootrel_posix : str
+        Relative path (POSIX) of the directory containing the file.
+    file : str
+        Filename.
+    fpstat : os.stat_result or None
+        Result of stat() on the file, obtained while walking the tree. None
+        if the file has disappeared in the mean time.
+    digests : sequence of str, optional
+        Names (hashlib) of the digests to calculate. The default is ('md5',).
+    nohash : boolean, optional
+        Do not calculate the digests. The default is False.
+
+    Returns
+    -------
+    list
+        TSV line (timestamp_iso, rel_path_posix, filename, mtime_iso, size,
+        followed by one column per digest) for this file.
+
+    """
+    timestamp_iso = datetime.now().isoformat()
+    # Files might be gone between walking the directory and actual
+    # scan. Not a problem (if limited to a few files)
+    #TODO: emit warning and/or set limit
+    try:
+        if fpstat is None:
+            raise FileNotFoundError(filepath)
+        fpsize = fpstat.st_size
+        mtime_iso = datetime.fromtimestamp(fpstat.st_mtime).isoformat()
+        if nohash:
+            # still check that the file can be opened
+            os.close(os.open(filepath, os.O_RDONLY))
+            hexdigests = ['' for name in digests]
+        else:
+            hexdigests = hash_file(filepath, fpsize, digests)
+    except FileNotFoundError:
+        # insert place holder info
+        # keeping the file list in sync
+        mtime_iso = timestamp_iso 
+        fpsize = 0
+        hexdigests = ['!FILE_GONE' for name in digests]
+    return [timestamp_iso,
+            rootrel_posix,
+            file,
+            mtime_iso,
+            fpsize] + hexdigests
+
+
+class PreviousIndex:
+    """
+    Digests from a previous superhash file, re-used for files of which the
+    size and modification time have not changed.
+
+    The previous file is read sequentially, in step with the current scan,
+    since both are in the same sorted order. Memory use does therefore not
+    depend on the size of the previous file.
+    """
+    def __init__(self, fpn, digests=('md5',), rehash_fraction=0.0):
+        columns = read_superhash_columns(fpn)
+        missing = [name for name in digests if name+'digest' not in columns]
+        if missing:
+            raise ValueError(f'No {",".join(missing)} digests in "{fpn}"')
+        self.digestix = [columns.index(name+'digest') for name in digests]
+        self.digests = digests
+        self.rows = iter_superhash_rows(fpn)
+        self.prevln = next(self.rows, None)
+        self.rehash_fraction = rehash_fraction
+        self.Nreused = 0
+        self.Nrehashed = 0
+        self.mismatches = []
+
+    def lookup(self, rootrel_posix, file):
+        """
+        Return the previous TSV line for rootrel_posix, file, or None if not
+        found.
+
+        Lookups should be done in scan order. Lines of the previous file
+        that are skipped over (deleted files) are not visited again.
+        """
+        key = (rootrel_posix, file)
+        while (self.prevln is not None) and \
+              ((self.prevln[1], self.prevln[2]) < key):
+            self.prevln = next(self.rows, None)
+        if (self.prevln is not None) and \
+           ((self.prevln[1], self.prevln[2]) == key):
+            return self.prevln
+        return None
+
+    def task(self, filepath, rootrel_posix, file, fpstat):
+        """
+        Return the (function, arguments) task for the file: re-use of the
+        previous digest if size and mtime are unchanged, hashing otherwise.
+        A random fraction (rehash_fraction) of the unchanged files is
+        hashed anyway, to detect silent corruption ('bit rot').
+        """
+        hashtask = (scan_file,
+                    (filepath, rootrel_posix, file, fpstat, self.digests))
+        prevln = self.lookup(rootrel_posix, file)
+        if (prevln is None) or (fpstat is None):
+            return hashtask
+        prevdigests = [prevln[ix] for ix in self.digestix]
+        if any((d == '') or d.startswith('!') for d in prevdigests):
+            return hashtask
+        mtime_iso = datetime.fromtimestamp(fpstat.st_mtime).isoformat()
+        if (fpstat.st_size != int(prevln[4])) or (mtime_iso != prevln[3]):
+            return hashtask
+        if random.random() < self.rehash_fraction:
+            self.Nrehashed += 1
+            return (self.rehash_file,
+                    (filepath, rootrel_posix, file, fpstat, prevln,
+                     prevdigests))
+        self.Nreused += 1
+        return (self.reuse_line, (prevln, prevdigests))
+
+    def reuse_line(self, prevln, prevdigests):
+        return [datetime.now().isoformat(),
+                prevln[1],
+                prevln[2],
+                prevln[3],
+                int(prevln[4])] + prevdigests
+
+    def rehash_file(self, filepath, rootrel_posix, file, fpstat, prevln,
+                    prevdigests):
+        ln = scan_file(filepath, rootrel_posix, file, fpstat, self.digests)
+        if (ln[3] == prevln[3]) and (ln[4] == int(prevln[4])) \
+           and (ln[5:] != prevdigests):
+            # list.append is thread-safe
+            self.mismatches.append(ln)
+            tqdm.write('WARNING: digest changed, but size and mtime did not: '
+                       f'"{rootrel_posix}/{file}"')
+        return ln
+
+
+def scandir_walk(top, toprel, resume_dir=None):
+    """
+    Walk the directory tree top, like os.walk(), but yielding the directories
+    in sorted order of their (POSIX) path.
+
+    Directories to be visited are kept in a heap. A directory is always
+    popped from the heap before its sub-directories are pushed, so the
+    directories come out in the same order as sorted(os.walk(top)), without
+    listing the whole tree first. Memory use depends on the depth and
+    width of the tree, not on the total number of files. The sort key is the
+    POSIX path, so that the order is the same on all platforms.
+
+    Symbolic links to directories are listed, but not followed. Directories
+    that cannot be read are reported and skipped.
+
+    If resume_dir is given, the directories that can only contain files that
+    come before resume_dir in the sorted order are skipped without being
+    scanned. This is used for resuming an interrupted superhash run.
+
+    Parameters
+    ----------
+    top : str
+        Top directory of the tree.
+    toprel : str
+        Relative POSIX path of the top directory, as stored in the result
+        file.
+    resume_dir : str, optional
+        Relative POSIX path of the directory at which to resume walking.
+
+    Yields
+    ------
+    dirpath : str
+        Path of the directory.
+    dirrel_posix : str
+        Relative POSIX path of the directory.
+    dirnames : list of str
+        Sorted names of the sub-directories.
+    fileentries : list of os.DirEntry
+        Entries for the files in the directory, sorted by name. Their
+        stat() results are cached.
+
+    """
+    heap = [(toprel, top)]
+    while heap:
+        dirrel_posix, dirpath = heapq.heappop(heap)
+        if (resume_dir is not None) and (dirrel_posix+'/' < resume_dir) \
+           and not resume_dir.startswith(dirrel_posix+'/'):
+            # this directory and all of its sub-directories come before
+            # resume_dir: no need to scan them
+            continue
+        dirnames = []
+        fileentries = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        dirnames.append(entry.name)
+                        try:
+                            walk_into = not entry.is_symlink()
+                        except OSError:
+                            walk_into = False
+                        if walk_into:
+                            heapq.heappush(heap,
+                                           (dirrel_posix+'/'+entry.name,
+                                            entry.path))
+                    else:
+                        fileentries.append(entry)
+        except OSError as err:
+            tqdm.write(f'WARNING: cannot read directory "{dirpath}" ({err})')
+            continue
+        dirnames.sort()
+        fileentries.sort(key=lambda entry: entry.name)
+        yield dirpath, dirrel_posix, dirnames, fileentries
+
+
+def walk_tasks(p_src_abs, p_result_abs, digests=('md5',), nohash=False,
+               previous=None, resume_after=None):
+    """
+    Walk the source tree and generate the (function, arguments, device)
+    tasks for all files, in sorted order (directories sorted by path, and
+    files sorted inside each directory). device is the st_dev of the file,
+    or None if the file has disappeared.
+
+    If previous (PreviousIndex) is given, digests are re-used from the
+    previous superhash file where possible. If resume_after is given (a
+    tuple of relative POSIX path and filename), all files up to and including
+    this one are skipped.
+    """
+    result_path = os.path.normcase(str(p_result_abs))
+    toprel = Path(os.path.relpath(p_src_abs, p_src_abs.parent)).as_posix()
+    for root, rootrel_posix, subdirs, fileentries in \
+            tqdm(scandir_walk(str(p_src_abs), toprel,
+                              resume_after[0] if resume_after else None),
+                 unit='dir'):
+        for entry in tqdm(fileentries, leave = False):
+            file = entry.name
+            if (resume_after is not None) and \
+               ((rootrel_posix, file) <= resume_after):
+                continue
+            if os.path.normcase(entry.path) == result_path:
+                print("Error: The result file must not be inside the scanned directory tree.", file=sys.stderr)
+                sys.exit(2)
+            try:
+                fpstat = entry.stat()
+            except FileNotFoundError:
+                fpstat = None
+            device = None if (fpstat is None) else fpstat.st_dev
+            if previous is None:
+                yield (scan_file,
+                       (entry.path, rootrel_posix, file, fpstat, digests,
+                        nohash),
+                       device)
+            else:
+                yield previous.task(entry.path, rootrel_posix, file,
+                                    fpstat) + (device,)
+
+
+def header_digest(headerlines):
+    """MD5 hex digest of the header lines, for checking header integrity"""
+    return hashlib.md5(''.join(headerlines).encode('utf-8')).hexdigest()
+
+
+def write_checkpoint(fout, nlines, lastkey, hdigest):
+    """
+    Write a checkpoint record into the TSV block of the result file, and
+    make sure that it is on disk (fsync).
+
+    The checkpoint records the number of TSV lines written, the byte offset
+    of the end of the last complete line (which is the start of the
+    checkpoint record itself), the path and filename of the last line
+    written, and the digest of the file header.
+    """
+    fout.flush()
+    ckpt = {'lines': nlines,
+            'offset': fout.tell(),
+            'rel_path_posix': lastkey[0] if lastkey else None,
+            'filename': lastkey[1] if lastkey else None,
+            'header-md5': hdigest}
+    fout.write('#CHECKPOINT\t'+json.dumps(ckpt, ensure_ascii=False)+'\n')
+    if isinstance(fout, CompressedTextWriter):
+        fout.sync()
+    else:
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+def find_last_checkpoint(fpn):
+    """
+    Find the last valid checkpoint record in a superhash file, by searching
+    backwards from the end of the file.
+
+    A checkpoint record is only considered valid if it is complete and if
+    the offset that it records is its actual position in the file.
+
+    Returns
+    -------
+    ckpt : dict or None
+        Checkpoint record. None if no valid checkpoint was found.
+    ckptend : int
+        Byte offset of the end of the checkpoint record.
+    ckptuend : int
+        Offset of the end of the checkpoint record in the uncompressed data
+        (identical to ckptend for files that are not compressed).
+
+    """
+    if is_compressed(fpn):
+        return find_last_checkpoint_compressed(fpn)
+    marker = b'\n#CHECKPOINT\t'
+    with open(fpn, 'rb') as fin:
+        pos = fin.seek(0, os.SEEK_END)
+        while pos > 0:
+            start = max(0, pos - CHECKPOINT_SEARCHSIZE)
+            fin.seek(start)
+            # overlap with the following block, for records across blocks
+            block = fin.read(pos - start + len(marker) - 1)
+            ix = block.rfind(marker)
+            while ix >= 0:
+                fin.seek(start + ix + 1)
+                line = fin.readline()
+                if line.endswith(b'\n'):
+                    try:
+                        ckpt = json.loads(line.split(b'\t', 1)[1])
+                    except ValueError:
+                        ckpt = None
+                    if (ckpt is not None) and \
+                       (ckpt.get('offset') == start + ix + 1):
+                        return ckpt, fin.tell(), fin.tell()
+                ix = block.rfind(marker, 0, ix + len(marker) - 1)
+            pos = start
+    return None, 0, 0
+
+
+def find_last_checkpoint_compressed(fpn):
+    """
+    Find the last valid checkpoint record in a compressed superhash file.
+
+    Checkpoint records are the last line of a compressed member (see
+    CompressedTextWriter). The members are decompressed one after the
+    other, up to the end of the file or up to an incomplete or corrupted
+    member, keeping only the last line of the data in memory.
+
+    Returns the same as find_last_checkpoint(). ckptend is the byte offset
+    of the end of the member ending with the checkpoint record.
+    """
+    if Path(fpn).suffix.lower() == '.gz':
+        decompressor = lambda: zlib.decompressobj(wbits=31)
+    else:
+        decompressor = lzma.LZMADecompressor
+    found = (None, 0, 0)
+    ucount = 0 # uncompressed bytes
+    partial = b'' # incomplete last line
+    lastline = b''
+    lastlinestart = 0
+    with open(fpn, 'rb') as fin:
+        dec = decompressor()
+        memberstart = 0 # byte offset of the current member
+        memberc = 0 # bytes of the current member already decompressed
+        data = fin.read(DECOMPRESS_BLOCKSIZE)
+        while data:
+            try:
+                out = dec.decompress(data)
+            except (zlib.error, lzma.LZMAError):
+                break
+            bufstart = ucount - len(partial)
+            buf = partial + out
+            ucount += len(out)
+            ix = buf.rfind(b'\n')
+            if ix >= 0:
+                prev = buf.rfind(b'\n', 0, ix)
+                lastline = buf[prev+1:ix+1]
+                lastlinestart = bufstart + prev + 1
+                partial = buf[ix+1:]
+            else:
+                partial = buf
+            if not dec.eof:
+                memberc += len(data)
+                data = fin.read(DECOMPRESS_BLOCKSIZE)
+                continue
+            # complete member: is its last line a valid checkpoint record?
+            memberend = memberstart + memberc + len(data) \
+                        - len(dec.unused_data)
+            if (not partial) and lastline.startswith(b'#CHECKPOINT\t'):
+                try:
+                    ckpt = json.loads(lastline.split(b'\t', 1)[1])
+                except ValueError:
+                    ckpt = None
+                if (ckpt is not None) and \
+                   (ckpt.get('offset') == lastlinestart):
+                    found = (ckpt, memberend, ucount)
+            data = dec.unused_data or fin.read(DECOMPRESS_BLOCKSIZE)
+            dec = decompressor()
+            memberstart = memberend
+            memberc = 0
+    return found
+
+
+def read_after(fpn, offset):
+    """
+    Read the data after byte offset in a superhash file, decompressed for
+    compressed files. Data that cannot be decompressed (e.g. an incomplete
+    last member) is left out.
+    """
+    with open(fpn, 'rb') as fin:
+        fin.seek(offset)
+        data = fin.read()
+    module = compressor(fpn)
+    if module is None:
+        return data
+    try:
+        return module.decompress(data)
+    except (EOFError, OSError, zlib.error, lzma.LZMAError):
+        return b''
+
+
+def directory_digests(fpn, digestname):
+    """
+    Calculate an aggregate (Merkle-tree) digest for each directory, from the
+    data lines of a superhash file.
+
+    The digest of a directory combines the digest of the list of its files
+    (filename, size and file digest, in sorted order) with the names and
+    digests of its child directories (in sorted order). Two directory trees
+    with the same files have the same digest, independent of the name of
+    the top directory and of the modification times of the files.
+
+    The lines of a directory are consecutive in the superhash file. Only a
+    few values per directory are kept in memory.
+
+    Parameters
+    ----------
+    fpn : str or pathlib.Path
+        Superhash file (the data lines are read up to the end of the file).
+    digestname : str
+        Digest used for combining (MD5 for 'quick'), also the file digest
+        (first digest column) used for each file.
+
+    Returns
+    -------
+    dirs : list of list
+        For each directory, in sorted order: rel_path_posix, digest, number
+        of files and total bytes in the subtree, byte offset of the first
+        data line of the files in the directory itself (-1 if there are none)
+        and the number of these files.
+
+    """
+    hashname = 'md5' if (digestname == 'quick') else digestname
+    nodes = {} # rel_path_posix -> [filesdigest, Nfiles, Nbytes, offset, Nown]
+    children = {}
+    hasher = None
+    current = None
+    with open_superhash(fpn, 'rb') as fin:
+        for line in fin:
+            if line.startswith(b'# timestamp_iso'):
+                break
+        offset = fin.tell()
+        for line in fin:
+            lineoffset = offset
+            offset += len(line)
+            if line.startswith(b'#') or not line.endswith(b'\n'):
+                continue
+            fields = line.rstrip(b'\r\n').decode('utf-8').split('\t')
+            if fields[1] != current:
+                if current is not None:
+                    nodes[current][0] = hasher.hexdigest()
+                current = fields[1]
+                hasher = hashlib.new(hashname)
+                nodes[current] = [None, 0, 0, lineoffset, 0]
+                # register the directory with all its parents
+                rel = current
+                while '/' in rel:
+                    parent, name = rel.rsplit('/', 1)
+                    if parent in children:
+                        children[parent].add(name)
+                        break
+                    children[parent] = {name}
+                    rel = parent
+                children.setdefault(current, set())
+            node = nodes[current]
+            node[4] += 1
+            node[2] += int(fields[4])
+            hasher.update((fields[2]+'\t'+fields[4]+'\t'+fields[5]+'\n').\
+                          encode('utf-8'))
+    if current is not None:
+        nodes[current][0] = hasher.hexdigest()
+    dirs = []
+    # children sort after their parents: calculate in reverse sorted order
+    for rel in sorted(children, reverse=True):
+        own = nodes.get(rel, [hashlib.new(hashname).hexdigest(),
+                              0, 0, -1, 0])
+        hasher = hashlib.new(hashname)
+        hasher.update(('files\t'+own[0]+'\n').encode('utf-8'))
+        Nfiles = own[4]
+        Nbytes = own[2]
+        for name in sorted(children[rel]):
+            child = nodes[rel+'/'+name]
+            hasher.update(('dir\t'+name+'\t'+child[0]+'\n').encode('utf-8'))
+            Nfiles += child[1]
+            Nbytes += child[2]
+        nodes[rel] = [hasher.hexdigest(), Nfiles, Nbytes, own[3], own[4]]
+        dirs.append([rel] + nodes[rel])
+    dirs.reverse()
+    return dirs
+
+
+def device_rotational(device):
+    """
+    Whether the block device st_dev is a spinning disk: True, False, or None
+    if unknown (only known on Linux).
+    """
+    if not hasattr(os, 'major'):
+        return None
+    sysdev = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'
+    # partitions do not have their own queue
+    for fpn in (sysdev+'/queue/rotational', sysdev+'/../queue/rotational'):
+        try:
+            with open(fpn, 'r') as fin:
+                return fin.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+
+class DeviceJobs:
+    """
+    Number of files to hash concurrently on each device (--device-jobs).
+
+    The limit for a device is taken from the first of: a limit given for a
+    path on that device, the limit for spinning disks ('hdd') or for other
+    devices ('ssd'), and the default (--jobs).
+    """
+    def __init__(self, jobs=1, specs=()):
+        self.jobs = jobs
+        self.kinds = {}
+        self.devices = {}
+        for spec in specs:
+            key, _, njobs = spec.rpartition('=')
+            if not key:
+                raise ValueError(f'"{spec}" is not of the form PATH=N')
+            try:
+                njobs = int(njobs)
+            except ValueError:
+                raise ValueError(f'"{njobs}" is not a number in "{spec}"')
+            if njobs < 1:
+                raise ValueError(f'number of jobs should be at least 1 in'
+                                 f' "{spec}"')
+            if key in ('hdd', 'ssd'):
+                self.kinds[key] = njobs
+            else:
+                self.devices[os.stat(key).st_dev] = njobs
+
+    def limit(self, device):
+        """Returns the limit and a description of the device"""
+        if device in self.devices:
+            return self.devices[device], 'set by path'
+        rotational = None if device is None else device_rotational(device)
+        kind = {True: 'hdd', False: 'ssd', None: 'unknown'}[rotational]
+        return self.kinds.get(kind, self.jobs), kind
+
+
+def ordered_map(tasks, jobs=1, devicejobs=None):
+    """
+    Run each task (a tuple of a function, its arguments and the device of
+    the file), yielding the results in the order of the tasks.
+
+    With jobs > 1, or if devicejobs (DeviceJobs) is given, the tasks are
+    run in a pool of threads for each device, with the number of threads
+    given by devicejobs (default: jobs for every device). A slow device
+    (e.g. a spinning disk, which is best read by a single thread) then does
+    not hold back the reads from other devices, and the reads from each
+    device are limited separately. Hashing is mostly done inside hashlib and
+    file reads, which release the GIL, so threads do run concurrently.
+    Only a limited number of tasks is submitted ahead of the result being
+    yielded, keeping memory use bounded (at most a few CHUNKSIZE buffers
+    per thread).
+    """
+    if (jobs <= 1) and (devicejobs is None):
+        for func, args, device in tasks:
+            yield func(*args)
+        return
+    if devicejobs is None:
+        devicejobs = DeviceJobs(jobs)
+    pools = {}
+    nthreads = 0
+    try:
+        pending = deque()
+        for func, args, device in tasks:
+            pool = pools.get(device)
+            if pool is None:
+                njobs, kind = devicejobs.limit(device)
+                pool = pools[device] = ThreadPoolExecutor(max_workers=njobs)
+                nthreads += njobs
+                if device is not None:
+                    tqdm.write(f'Device {device:#x} ({kind}): {njobs:d}'
+                               ' concurrent file(s)')
+            pending.append(pool.submit(func, *args))
+            # the queue is long enough to keep all devices busy while the
+            # oldest task (on a slower device) is still running
+            if len(pending) >= DEVICE_QUEUE*nthreads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+#%% main program
+
 cli = argparse.ArgumentParser()
 cli.add_argument('-n', '--nohash', action='store_true',
                  help='do not calculate hashes, only generate file info tree')
@@ -30,6 +955,42 @@ cli.add_argument("-r", "--resume", type=str,
                  help="resume superhash based on existing file")
 cli.add_argument("-s", "--src_dir", type=str,
                  help="source directory to be scanned")
+cli.add_argument("-j", "--jobs", type=int, default=1,
+                 help="number of files to hash concurrently (default: 1)")
+cli.add_argument("--device-jobs", type=str, action='append', default=[],
+                 metavar='PATH=N',
+                 help="number of files to hash concurrently on the device"
+                      " containing PATH, or on all spinning disks (hdd=N) or"
+                      " all other devices (ssd=N). Can be repeated. The"
+                      " default for each device is --jobs.")
+cli.add_argument("--reuse-from", type=str,
+                 help="previous superhash file, from which digests are re-used"
+                      " for files with unchanged size and mtime")
+cli.add_argument("--rehash-fraction", type=float, default=0.01,
+                 help="fraction of unchanged files that is hashed anyway, with"
+                      " --reuse-from (default: 0.01)")
+cli.add_argument("-d", "--digests", type=str,
+                 help="comma-separated list of digests to calculate, e.g."
+                      " md5,sha256,blake2b,quick (default: md5)")
+cli.add_argument("-q", "--quick", action='store_true',
+                 help="calculate the quick fingerprint of each file (size,"
+                      " first and last MiB, sampled blocks), instead of or in"
+                      " addition to --digests")
+cli.add_argument("--io-policy", choices=['default', 'nocache', 'direct'],
+                 default='default',
+                 help="how files are read: 'nocache' keeps the files that are"
+                      " hashed out of the page cache, to avoid slowing down"
+                      " other programs, 'direct' reads large files with"
+                      " direct I/O (default: default)")
+cli.add_argument("--max-rate", type=float, metavar='MB/S',
+                 help="maximum read rate for hashing, in MB/s")
+cli.add_argument("--max-files", type=float, metavar='FILES/S',
+                 help="maximum number of files hashed per second")
+cli.add_argument("-z", "--compress", choices=['gz', 'xz'],
+                 help="compress the result file (gzip or xz). The suffix"
+                      " .gz or .xz is added to the name of the result file"
+                      " if needed. Result files with these suffixes are"
+                      " always compressed.")
 clargs = cli.parse_args()
 
 print('')
@@ -37,6 +998,79 @@ print("This is MANBAMM's superhash - v"+__version__+\
       " - by M.H.V. Werts, 2022-2026")
 print("")
 
+if clargs.jobs < 1:
+    print("Error: --jobs should be at least 1", file=sys.stderr)
+    sys.exit(2)
+
+if clargs.device_jobs:
+    try:
+        devicejobs = DeviceJobs(clargs.jobs, clargs.device_jobs)
+    except (ValueError, OSError) as err:
+        print(f'Error: --device-jobs: {err}', file=sys.stderr)
+        sys.exit(2)
+else:
+    devicejobs = None
+
+if not IOPolicy.supported(clargs.io_policy):
+    print(f'Error: --io-policy {clargs.io_policy} is not supported on this'
+          ' platform', file=sys.stderr)
+    sys.exit(2)
+if ((clargs.max_rate is not None) and (clargs.max_rate <= 0)) or \
+   ((clargs.max_files is not None) and (clargs.max_files <= 0)):
+    print("Error: --max-rate and --max-files should be positive",
+          file=sys.stderr)
+    sys.exit(2)
+io_policy = IOPolicy(clargs.io_policy,
+                     clargs.max_rate*1e6 if clargs.max_rate else None,
+                     clargs.max_files)
+
+if clargs.quick:
+    if clargs.digests is None:
+        clargs.digests = 'quick'
+    elif 'quick' not in clargs.digests.lower().split(','):
+        clargs.digests += ',quick'
+
+if clargs.digests is not None:
+    digests = clargs.digests.lower().split(',')
+    for name in digests:
+        if ((name not in hashlib.algorithms_guaranteed) or \
+            name.startswith('shake')) and not (name == 'quick'):
+            print(f'Error: Unsupported digest "{name}"', file=sys.stderr)
+            sys.exit(2)
+    if len(set(digests)) != len(digests):
+        print("Error: Duplicate digest in --digests", file=sys.stderr)
+        sys.exit(2)
+
+if clargs.resume is not None:
+    # Continue with the digests of the file to be resumed
+    try:
+        filedigests = [col[:-len('digest')] 
+                       for col in read_superhash_columns(clargs.resume)[5:]]
+    except (ValueError, EOFError, OSError, lzma.LZMAError) as err:
+        print(f'Error: {err}', file=sys.stderr)
+        sys.exit(2)
+    if (clargs.digests is not None) and (digests != filedigests):
+        print('Error: --digests differs from the digests in the superhash file',
+              file=sys.stderr)
+        sys.exit(2)
+    digests = filedigests
+elif clargs.digests is None:
+    digests = ['md5']
+
+if clargs.reuse_from is not None:
+    if clargs.nohash:
+        print("Error: --reuse-from cannot be combined with --nohash",
+              file=sys.stderr)
+        sys.exit(2)
+    try:
+        previous = PreviousIndex(clargs.reuse_from, digests,
+                                 clargs.rehash_fraction)
+    except ValueError as err:
+        print(f'Error: Cannot re-use digests. {err}', file=sys.stderr)
+        sys.exit(2)
+else:
+    previous = None
+
 dtn = datetime.now()
 
 if clargs.resume is not None:
@@ -46,81 +1080,69 @@ if clargs.resume is not None:
     p_result = Path(clargs.resume)
     p_result_abs = p_result.resolve(strict=False)
    
-    with open(p_result, 'r', encoding='utf-8') as fin:
-        rdr = csv.reader(fin, delimiter='\t', quoting=csv.QUOTE_NONE)
-        header = [rdr.__next__() for i in range(4)]
-        if not (header[0][0] == '# superhash-version'):
-            print(f'Error: not a superhash file "{clargs.resume}"')
-            sys.exit(2)
-        if not (header[0][1] == __version__):
-            print('Error: File generated with a different version of superhash. Revise your script.', 
-                  file=sys.stderr)
-            print('       File generated with v'+header[0][1]+', current software v'+__version__,
-                  file=sys.stderr)
-            sys.exit(2)
-        
-        # This header line contains the absolute path as a posix string
-        # Readily converted back to an actual path
-        p_src_abs = Path(header[2][1])
+    try:
+        with open_superhash(p_result) as fin:
+            headerlines = [fin.readline()]
+            if not headerlines[0].startswith('# superhash-version\t'):
+                print(f'Error: not a superhash file "{clargs.resume}"', 
+                      file=sys.stderr)
+                sys.exit(2)
+            header = [headerlines[0].rstrip('\n').split('\t')]
+            if not (header[0][1] == __version__):
+                print('Error: File generated with a different version of superhash. Revise your script.', 
+                      file=sys.stderr)
+                print('       File generated with v'+header[0][1]+', current software v'+__version__,
+                      file=sys.stderr)
+                sys.exit(2)
+            for i in range(3):
+                headerlines.append(fin.readline())
+                header.append(headerlines[-1].rstrip('\n').split('\t'))
+            hdigestline = fin.readline().rstrip('\n').split('\t')
+    except (EOFError, OSError, lzma.LZMAError) as err:
+        # incomplete first member of a compressed file
+        print(f'Error: Cannot read superhash file "{clargs.resume}". {err}',
+              file=sys.stderr)
+        sys.exit(2)
+    
+    # Check header integrity. Checkpoints refer to the header digest.
+    hdigest = header_digest(headerlines)
+    if not (hdigestline == ['# superhash-header-md5', hdigest]):
+        print('Error: Header of superhash file has been altered. Cannot resume.',
+              file=sys.stderr)
+        sys.exit(2)
 
-        walklist = []
-        
-        line = fin.readline() # this is an empty '#' comment line
-        line = fin.readline()
-        assert line.strip() == "#BEGIN-WALKLIST-JSONL", "Ill-formatted input file. Cannot resume."
-         
-        for line in fin:
-            stripped = line.rstrip("\n")
-            if stripped == "#END-WALKLIST-JSONL":
-                break
-            assert stripped.startswith("#"), "malformed walklist line"
-            dirpath, dirnames, filenames = json.loads(stripped[1:])
-            walklist.append((dirpath, dirnames, filenames))
-            
-        line = fin.readline() # this is an empty '#' comment line
-        line = fin.readline()
-        assert line.strip() == "#BEGIN-SUPERHASH-TSV", "Ill-formatted input file. Cannot resume."
-        line = fin.readline() # skip TSV header line
-        
-       
-        print('Scanning for resume point...')
-
-        # Here we use a cheap scanning mechanism: just compare file-names
-        # This is not 100% without risk, but probably OK.
-        # Worst case: we skip/rescan some files and may have problems
-        # resuming again after a new interruption
-        #TODO: give this some extra scrutiny
-        # and perhaps add a check of the path (last few members)
-        
-        walkix = 0 # scan over walklist by index
-        tsvendfound = False
-        for root, subdirs, files in tqdm(walklist):
-            fileix=0
-            for file in tqdm(sorted(files), leave = False):
-                try:
-                    rawtsvln = rdr.__next__()
-                except StopIteration:
-                    tsvendfound = True
-                    break
-                if not file==rawtsvln[2]:
-                    print(f'Error: incompatible file names: "{file}" "{rawtsvln[2]}" ')
-                    sys.exit(2)
-                fileix+=1
-            if tsvendfound:
-                break                    
-            walkix+=1
-
-        # remove files already processed from current walklist line
-        walklist[walkix] = (walklist[walkix][0],
-                            walklist[walkix][1],
-                            walklist[walkix][2][fileix:])
-        # keep only remaining files from walklist
-        walklist = walklist[walkix:]
+    # This header line contains the absolute path as a posix string
+    # Readily converted back to an actual path
+    p_src_abs = Path(header[2][1])
+
+    # Find the last checkpoint. Everything after it (lines written since,
+    # an incomplete last line) is removed, and the tree walk continues
+    # directly after the last file recorded in the checkpoint.
+    ckpt, ckptend, uoffset = find_last_checkpoint(p_result)
+    if ckpt is None:
+        print('Error: No checkpoint found in superhash file. Cannot resume.',
+              file=sys.stderr)
+        sys.exit(2)
+    if not (ckpt['header-md5'] == hdigest):
+        print('Error: Checkpoint does not belong to this superhash file. Cannot resume.',
+              file=sys.stderr)
+        sys.exit(2)
+    if b'#END-SUPERHASH-TSV\n' in read_after(p_result, ckptend):
+        print('Superhash file is complete. Nothing to resume.')
+        sys.exit(0)
+    with open(p_result, 'r+b') as fres:
+        fres.truncate(ckptend)
+    nlines = ckpt['lines']
+    if ckpt['rel_path_posix'] is None:
+        resume_after = None
+    else:
+        resume_after = (ckpt['rel_path_posix'], ckpt['filename'])
+    print('Resuming after line {0:d}: "{1:s}"'.format(nlines,
+          '/'.join(resume_after) if resume_after else ''))
 
 else:
     #
-    # Start afresh. Create a fresh file, with a fresh header and a fresh
-    # walklist.
+    # Start afresh. Create a fresh file, with a fresh header.
     # 
     if clargs.src_dir is None:
         print("Error: Please supply a --src_dir", file=sys.stderr)
@@ -130,8 +1152,12 @@ else:
         print("Error: Specified source is not a directory", file=sys.stderr)
         sys.exit(2)
     p_src_abs = p_src.resolve(strict=True)
+    resume_after = None
+    nlines = 0
     
     md5st = 'noMD5' if clargs.nohash else ''
+    if (digests == ['quick']) and not clargs.nohash:
+        md5st = 'quick'
     dts = dtn.strftime('%y%m%d_%H%M%S')
     result_file = p_src_abs.stem+"_sh"+dts+md5st+".tsv"
     if clargs.outpath is None:
@@ -143,6 +1169,9 @@ else:
         else:
             result_file = clargs.outpath
             p_result = Path(result_file)
+    if (clargs.compress is not None) and \
+       not (p_result.suffix.lower() == '.'+clargs.compress):
+        p_result = Path(str(p_result)+'.'+clargs.compress)
     
     p_result_abs = p_result.resolve(strict=False)
     
@@ -150,29 +1179,16 @@ else:
     print('Output file     :   ', str(p_result))
     print('')
 
-    with open(p_result, 'w', encoding='utf-8') as fout:
+    with open_result(p_result, 'w') as fout:
         writer = csv.writer(fout, delimiter='\t', lineterminator='\n',
                             quoting=csv.QUOTE_NONE)
-        writer.writerow(['# superhash-version', __version__])
-        writer.writerow(['# superhash-start-timestamp-iso', dtn.isoformat()])
-        writer.writerow(['# absolute-path-source-dir',p_src_abs.as_posix()])
-        writer.writerow(['# absolute-path-superhash-file',p_result_abs.as_posix()])
-
-        
-        # Cold start 
-        print('Preparing file list... please stand by...')
-        
-        # sorts according to root, keeping the subdirs and files in sync
-        walklist = sorted(list(os.walk(p_src_abs)))
-        
-        # insert walklist as JSONL block into file to enable the restart of an 
-        # aborted superhash scan
-        fout.write("#\n")
-        fout.write("#BEGIN-WALKLIST-JSONL\n")
-        for dirpath, dirnames, filenames in walklist:
-            line = json.dumps([dirpath, dirnames, filenames], ensure_ascii=False)
-            fout.write("#" + line + "\n")
-        fout.write("#END-WALKLIST-JSONL\n")
+        headerlines = ['# superhash-version\t'+__version__+'\n',
+                       '# superhash-start-timestamp-iso\t'+dtn.isoformat()+'\n',
+                       '# absolute-path-source-dir\t'+p_src_abs.as_posix()+'\n',
+                       '# absolute-path-superhash-file\t'+p_result_abs.as_posix()+'\n']
+        hdigest = header_digest(headerlines)
+        fout.writelines(headerlines)
+        writer.writerow(['# superhash-header-md5', hdigest])
         fout.write("#\n")
          
         # start of actual TSV block
@@ -181,71 +1197,62 @@ else:
                          'rel_path_posix',
                          'filename',
                          'mtime_iso',
-                         'size',
-                         'md5digest'])
-
-print()
-print('Done! Moving on...')
-print()
+                         'size']
+                        + [name+'digest' for name in digests])
+        write_checkpoint(fout, nlines, None, hdigest)
+        uoffset = fout.tell()
 
 
 # Reopen file in APPEND mode to write the TSV superhash lines
 #  do not forget to re-instantiate the CSV writer
-with open(p_result, 'a', encoding='utf-8') as fout:
+# The tree is walked while hashing. The lines are written in sorted order,
+# also when hashing with several jobs, so that --resume works.
+# Every CHECKPOINT_INTERVAL seconds, a checkpoint is written, from which
+# --resume continues.
+# Compressed files are written as a series of compressed members, one for
+# each checkpoint.
+with open_result(p_result, 'a', uoffset) as fout:
     writer = csv.writer(fout, delimiter='\t', lineterminator='\n',
                         quoting=csv.QUOTE_NONE)
-    for root, subdirs, files in tqdm(walklist):
-        checksums = []
-        rootrelative = os.path.relpath(root, p_src_abs.parent)
-        # enforce storing pathnames as posix
-        rootrel_posix = Path(rootrelative).as_posix()
-        # sort also the files inside each directory
-        for file in tqdm(sorted(files), leave = False):
-            filepath = Path(root, file)
-            if (filepath.resolve() == p_result_abs):
-                # tqdm.write('... skipping result file itself ('\
-                #            +str(p_result)+')')
-                print("Error: The result file must not be inside the scanned directory tree.", file=sys.stderr)
-                print("Tip:   Try renaming the result file in-place and restart. It will not be in the walklist anymore.", file=sys.stderr)
-                sys.exit(2)
-            else:
-                timestamp_iso = datetime.now().isoformat()
-                # Files might be gone between creation of walklist and actual
-                # scan. Not a problem (if limited to a few files)
-                #TODO: emit warning and/or set limit
-                if filepath.exists():
-                    fpstat = filepath.stat()
-                    fpsize = fpstat.st_size
-                    mtime_iso = datetime.fromtimestamp(fpstat.st_mtime).isoformat()
-                    with open(filepath, 'rb') as _file:
-                        if clargs.nohash:
-                            md5digest = ''
-                        else:
-                            cumhash = hashlib.md5()
-                            for chunk in iter(lambda: _file.read(CHUNKSIZE), b''):
-                                cumhash.update(chunk)
-                            md5digest = cumhash.hexdigest()
-                else:
-                    # insert place holder info
-                    # keeping the file list in sync
-                    mtime_iso = timestamp_iso 
-                    fpsize = 0
-                    md5digest = '!FILE_GONE'
-
-                checksums.append([timestamp_iso,
-                                  rootrel_posix,
-                                  file,
-                                  mtime_iso,
-                                  fpsize,
-                                  md5digest])
-        writer.writerows(checksums)
+    lastkey = resume_after
+    tckpt = time.monotonic()
+    for row in ordered_map(walk_tasks(p_src_abs, p_result_abs, digests,
+                                      clargs.nohash, previous, resume_after),
+                           clargs.jobs, devicejobs):
+        writer.writerow(row)
+        nlines += 1
+        lastkey = (row[1], row[2])
+        if (time.monotonic() - tckpt) > CHECKPOINT_INTERVAL:
+            write_checkpoint(fout, nlines, lastkey, hdigest)
+            tckpt = time.monotonic()
+    write_checkpoint(fout, nlines, lastkey, hdigest)
+
+    # Aggregate digests of all directories, calculated from the complete
+    # TSV block. On --resume, these are calculated again, for the full file.
+    # The final line records the position of the block, so that it can be
+    # found from the end of the file.
+    dirs = directory_digests(p_result, digests[0])
+    dirsoffset = fout.tell()
+    writer.writerow(['#DIRS', digests[0]])
+    for rec in dirs:
+        writer.writerow(['#DIR'] + rec)
+    writer.writerow(['#DIRS-OFFSET', dirsoffset])
         
     # Write end marker. The presence of this marker indicates that the
     # full tree was scanned and included in the superhash file.
-    # If the marker is absent (v0.2 file format), this signifies that
+    # If the marker is absent (v0.2+ file format), this signifies that
     # the superhash data in the file is incomplete.
-    #TODO: include this in 'superhash-check.py'
     fout.write("#END-SUPERHASH-TSV\n")
     fout.write("#\n")
+
+if previous is not None:
+    print('')
+    print('Digests re-used from previous file :', previous.Nreused)
+    print('Unchanged files hashed as check     :', previous.Nrehashed)
+    if previous.mismatches:
+        print('WARNING: {0:d} file(s) changed contents without change in size'
+              ' or mtime:'.format(len(previous.mismatches)))
+        for ln in previous.mismatches:
+            print('   ', ln[1]+'/'+ln[2])
 print('')
 print('')
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+r"""
+## superhash_format: reading superhash files
+
+Functions shared by superhash.py, superhash-check.py, superhash-catalogue.py
+and superhash-dupes.py for reading superhash files: opening (compressed)
+files, the header, the data lines of the TSV block, and the 'quick'
+fingerprint, which has to be calculated in exactly the same way when
+hashing and when verifying.
+
+Layout of a superhash file (v0.6):
+
+    # superhash-version	0.6
+    # superhash-start-timestamp-iso	...
+    # absolute-path-source-dir	...
+    ...                                  (other header lines)
+    # timestamp_iso	rel_path_posix	filename	mtime_iso	size	md5digest ...
+    ...                                  (data lines, checkpoints '#CHECKPOINT')
+    #END-SUPERHASH-TSV
+"""
+
+# superhash file format version, identical to the version of superhash.py
+__version__ = '0.6'
+
+import os
+import re
+import gzip
+import lzma
+import hashlib
+import csv
+
+DROPPATHPARTS = 1 # Number of intial parts of the path to drop (ideally, 1)
+QUICK_SIZE = 1048576 # 'quick' fingerprint: first and last 1 MiB of the file,
+QUICK_SAMPLES = 4    #   and 4 evenly spaced blocks
+QUICK_SAMPLESIZE = 65536 #   of 64 kiB
+
+# superhash files with these suffixes are compressed
+COMPRESSORS = {'.gz': gzip, '.xz': lzma}
+
+#%% classes and functions
+
+def compressor(fpn):
+    """Compression module (gzip, lzma) for a superhash file, or None"""
+    return COMPRESSORS.get(os.path.splitext(os.fspath(fpn))[1].lower())
+
+
+def is_compressed(fpn):
+    return compressor(fpn) is not None
+
+
+def open_superhash(fpn, mode='r'):
+    """
+    Open a superhash file for reading, as text (mode 'r') or binary (mode
+    'rb'). Compressed files (.gz, .xz) are decompressed transparently.
+    """
+    module = compressor(fpn)
+    if mode == 'rb':
+        return open(fpn, 'rb') if (module is None) else module.open(fpn, 'rb')
+    if module is None:
+        return open(fpn, 'r', encoding='utf-8', newline='\n')
+    return module.open(fpn, 'rt', encoding='utf-8', newline='\n')
+
+
+def tsv_reader(fin):
+    """csv.reader for a superhash file opened as text"""
+    return csv.reader(fin, delimiter='\t', quoting=csv.QUOTE_NONE)
+
+
+def version_tuple(version):
+    return tuple(int(n) for n in re.findall(r'\d+', version))
+
+
+def clean_posix(rel_path_posix):
+    """Drop the intial DROPPATHPARTS parts of a POSIX path string"""
+    return '/'.join(rel_path_posix.split('/')[DROPPATHPARTS:])
+
+
+def read_header(rdr):
+    """
+    Read the header of a superhash file, up to and including the TSV column
+    header.
+
+    Parameters
+    ----------
+    rdr : csv.reader
+        Reader positioned at the start of the superhash file.
+
+    Returns
+    -------
+    header : list
+        Header lines, split into fields.
+    digests : list of str
+        Names of the digests in the digest columns (e.g. 'md5').
+
+    """
+    header = []
+    rawln = []
+    for rawln in rdr:
+        if rawln[0] == '# timestamp_iso':
+            break
+        # skip other comment lines, such as the JSONL walklist block (v0.2)
+        if rawln[0].startswith('# '):
+            header.append(rawln)
+    if not (header and (header[0][0] == '# superhash-version')):
+        raise Exception('Not a superhash file')
+    if version_tuple(header[0][1]) > version_tuple(__version__):
+        print('*** WARNING! File generated with a newer version of superhash ***')
+        print('    File generated with v'+header[0][1]+', current software v'+__version__)
+    # one column per digest, e.g. 'md5digest'
+    digests = [col[:-len('digest')] for col in rawln[5:]]
+    return header, digests
+
+
+def iter_rawlines(rdr):
+    """
+    Iterate over the data lines of the TSV block of a superhash file,
+    skipping comment lines. Stops at the end of the TSV block, or at an
+    incomplete last line.
+    """
+    for rawln in rdr:
+        if rawln[0].startswith('#'):
+            if rawln[0] == '#END-SUPERHASH-TSV':
+                break
+            continue
+        if len(rawln) < 6:
+            break
+        yield rawln
+
+
+def iter_tsv_lines(fin, endmarker=False):
+    """
+    Iterate over the data lines of the TSV block of a superhash file opened
+    as text, positioned after the column header (e.g. by read_header()).
+
+    Unlike iter_rawlines(), a last line without newline is recognised as
+    incomplete (interrupted superhash run), also if it has all columns.
+    With endmarker, the end marker ['#END-SUPERHASH-TSV'] is yielded as the
+    last line, if it is present.
+    """
+    for line in fin:
+        if line.startswith('#'):
+            if line.startswith('#END-SUPERHASH-TSV'):
+                if endmarker:
+                    yield ['#END-SUPERHASH-TSV']
+                break
+            continue
+        rawln = line.rstrip('\r\n').split('\t')
+        if (not line.endswith('\n')) or (len(rawln) < 6):
+            break
+        yield rawln
+
+
+def read_superhash_columns(fpn):
+    """
+    Return the list of column names of the TSV block of a superhash file.
+    The digest columns are named after the digest, e.g. 'md5digest'.
+    """
+    with open_superhash(fpn) as fin:
+        if not fin.readline().startswith('# superhash-version'):
+            raise ValueError(f'Not a superhash file "{fpn}"')
+        for line in fin:
+            if line.startswith('# timestamp_iso'):
+                return line[2:].rstrip('\r\n').split('\t')
+    raise ValueError(f'No TSV block in superhash file "{fpn}"')
+
+
+def iter_superhash_rows(fpn):
+    """
+    Iterate over the data lines of a superhash file.
+
+    Works with files with and without the JSONL walklist block. Comment lines
+    are skipped. Reading stops at the end of the TSV block, or at an
+    incomplete last line (interrupted superhash run).
+
+    Parameters
+    ----------
+    fpn : str or pathlib.Path
+        Superhash file.
+
+    Yields
+    ------
+    list of str
+        TSV line (timestamp_iso, rel_path_posix, filename, mtime_iso, size,
+        followed by the digest columns)
+
+    """
+    with open_superhash(fpn) as fin:
+        if not fin.readline().startswith('# superhash-version'):
+            raise ValueError(f'Not a superhash file "{fpn}"')
+        for line in fin:
+            if line.startswith('# timestamp_iso'):
+                break
+        yield from iter_tsv_lines(fin)
+
+
+def quick_digest(fin, fpsize, done=None):
+    """
+    Calculate the 'quick' fingerprint of a file: an MD5 digest of its size,
+    the first and last QUICK_SIZE bytes and QUICK_SAMPLES evenly spaced
+    blocks of QUICK_SAMPLESIZE bytes. Small files are hashed entirely.
+
+    The fingerprint detects truncated files and grossly corrupted copies,
+    reading only a small part of large files.
+
+    Parameters
+    ----------
+    fin : file
+        The file, opened for reading in binary mode.
+    fpsize : int
+        Size of the file.
+    done : callable, optional
+        Called as done(offset, nbytes) after each read.
+
+    Returns
+    -------
+    hashlib.md5 object
+
+    """
+    hasher = hashlib.md5('superhash-quick\t{0:d}\t{1:d}\t{2:d}\t{3:d}\n'.\
+                         format(fpsize, QUICK_SIZE, QUICK_SAMPLES,
+                                QUICK_SAMPLESIZE).encode('utf-8'))
+    if fpsize <= 2*QUICK_SIZE + QUICK_SAMPLES*QUICK_SAMPLESIZE:
+        blocks = [(0, -1)]
+    else:
+        blocks = [(0, QUICK_SIZE)]
+        for i in range(1, QUICK_SAMPLES+1):
+            blocks.append((fpsize*i//(QUICK_SAMPLES+1), QUICK_SAMPLESIZE))
+        blocks.append((fpsize - QUICK_SIZE, QUICK_SIZE))
+    for offset, size in blocks:
+        fin.seek(offset)
+        data = fin.read(size)
+        hasher.update(data)
+        if done is not None:
+            done(offset, len(data))
+    return hasher